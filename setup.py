@@ -51,5 +51,8 @@ setup(name='PyWebTools',
       entry_points="""
       [pytest11]
       pywebtools_testing = pywebtools.testing
+      [console_scripts]
+      pywebtools-sweep-tokens = pywebtools.pyramid.auth.tokens:sweep_main
+      pywebtools-dispatch-outbox = pywebtools.pyramid.auth.outbox:dispatch_main
       """
       )
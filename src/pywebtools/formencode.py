@@ -110,19 +110,40 @@ class PasswordValidator(FancyValidator):
     user-provided passwords against the database to allow / dissallow login.
 
     Requires a SQLAlchemy database session to be available via ``state.dbsession``.
+    On success the authenticated user is stored as ``state.user``, so that it does
+    not need to be loaded again.
+
+    If no user exists with the given e-mail address, then the password is still checked
+    against a new, password-less user, so that the response time does not reveal which
+    e-mail addresses are registered.
+
+    If a :class:`~pywebtools.pyramid.auth.throttle.LoginThrottle` is available via
+    ``state.throttle``, then it is checked before the user is loaded and any failed
+    login is recorded with it.
     """
 
-    messages = {'nologin': 'No user exists with the given e-mail address or the password does not match'}
+    messages = {'nologin': 'No user exists with the given e-mail address or the password does not match',
+                'throttled': 'Too many failed login attempts. Please try again later.'}
 
     def _validate_python(self, value, state):
         if hasattr(state, 'user_class'):
+            throttle = getattr(state, 'throttle', None)
+            address = state.request.client_addr if hasattr(state, 'request') else None
+            if throttle and not throttle.allowed(value['email'], address):
+                raise Invalid(self.message('throttled', state), value, state)
             user = state.dbsession.query(state.user_class).\
                 filter(state.user_class.email == value['email'].lower()).first()
-            if user:
-                if not user.password_matches(value['password']):
-                    raise Invalid(self.message('nologin', state), value, state)
-            else:
-                raise Invalid(self.message('nologin', state), value, state)
+            if user is None:
+                # Check against a password-less user, so that the check takes as long
+                state.user_class().password_matches(value['password'])
+            elif user.password_matches(value['password']):
+                if throttle:
+                    throttle.success(value['email'])
+                state.user = user
+                return
+            if throttle:
+                throttle.failure(value['email'], address)
+            raise Invalid(self.message('nologin', state), value, state)
         else:
             raise Invalid(self.message('nologin', state), value, state)
 
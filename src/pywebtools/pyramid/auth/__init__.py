@@ -14,11 +14,20 @@ function.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-from pywebtools.pyramid.auth import views
+from pyramid.exceptions import ConfigurationError
+from sqlalchemy.exc import UnboundExecutionError
+
+from pywebtools.pyramid.auth import views, passwords, tokens, outbox, search
+from pywebtools.pyramid.auth.decorators import get_current_user
+from pywebtools.pyramid.auth.models import permission_group_catalog
+from pywebtools.pyramid.util import convert_type
+from pywebtools.sqlalchemy import DBSession
 
 routes = ['user.login', 'user.logout', 'user.register', 'user.confirm', 'user.forgotten_password',
-          'user.reset_password', 'users', 'users.action', 'user.view', 'user.edit',
-          'user.permissions', 'user.delete']
+          'user.reset_password', 'users', 'users.action', 'users.export', 'user.autocomplete',
+          'user.view', 'user.edit', 'user.permissions', 'user.delete']
+# Routes whose views generate their own response and are registered without a renderer
+streaming_routes = ['users.export']
 active_urls = {'user.login': '/users/login',
                'user.logout': '/users/logout',
                'user.register': '/users/register',
@@ -27,6 +36,8 @@ active_urls = {'user.login': '/users/login',
                'user.reset_password': '/users/reset-password/{token}',
                'users': '/users',
                'users.action': '/users/action',
+               'users.export': '/users/export',
+               'user.autocomplete': '/users/autocomplete',
                'user.view': '/users/{uid}',
                'user.edit': '/users/{uid}/edit',
                'user.permissions': '/users/{uid}/permissions',
@@ -45,8 +56,53 @@ def init(config, renderers=None, urls=None, redirects=None, callbacks=None):
     * user.confirm - :func:`~pywebtools.pyramid.auth.views.confirm` (no redirection)
     * user.forgotten_password - :func:`~pywebtools.pyramid.auth.views.forgotten_password`
     * user.reset_password - :func:`~pywebtools.pyramid.auth.views.reset_password`
+    * user.autocomplete - :func:`~pywebtools.pyramid.auth.views.autocomplete` (use the "json"
+      renderer, no redirection)
+
+    If no renderer is provided for a route, then the route will not be registered. The
+    following routes generate their own response and are always registered:
+
+    * users.export - :func:`~pywebtools.pyramid.auth.views.export`
+
+    Also registers the reified ``current_user`` request method, which lazily loads the
+    currently logged in :class:`~pywebtools.pyramid.auth.models.User` once per request (see
+    :func:`~pywebtools.pyramid.auth.decorators.get_current_user`).
+
+    The password hashing (see :mod:`~pywebtools.pyramid.auth.passwords`) is configured via the
+    following settings:
+
+    * ``auth.password.hasher`` - The hasher to use for new passwords: "pbkdf2_sha512" (default)
+      or "scrypt"
+    * ``auth.password.cost`` - The hasher's cost (PBKDF2 iterations or scrypt log2(n))
+    * ``auth.password.target_ms`` - If no cost is set, calibrate the cost at startup so that
+      hashing a password takes about this many milliseconds
+    * ``auth.password.workers`` - The number of threads used for password hashing. If not set,
+      passwords are hashed in the request thread
+    * ``auth.password.max_pending`` - The maximum number of login password checks that may
+      wait for the hashing threads, before further logins are rejected
+
+    The permissions of each :class:`~pywebtools.pyramid.auth.models.PermissionGroup` are
+    cached in each process (see :class:`~pywebtools.pyramid.auth.models.PermissionGroupCatalog`).
+    The ``auth.permissions.catalog_ttl`` setting sets the number of seconds between checks for
+    changes made in other processes (default 1). If 0, changes are checked for on every access.
 
-    If no renderer is provided for a route, then the route will not be registered.
+    The tokens used for account confirmation and password resets (see
+    :mod:`~pywebtools.pyramid.auth.tokens`) are configured via the following settings:
+
+    * ``auth.tokens.backend`` - "database" (default) to store tokens as
+      :class:`~pywebtools.pyramid.auth.models.TimeToken` or "signed" to use stateless
+      HMAC-signed tokens
+    * ``auth.tokens.secret`` - The secret used to sign the tokens. Required if the backend
+      is "signed"
+
+    Expired :class:`~pywebtools.pyramid.auth.models.TimeToken` can be deleted periodically in
+    the application process by calling :func:`~pywebtools.pyramid.auth.tokens.start_sweeper`
+    (see :mod:`~pywebtools.pyramid.auth.tokens`), which uses the following settings:
+
+    * ``auth.tokens.sweep_interval`` - The number of seconds between deleting expired tokens. If
+      not set, no tokens are deleted in the application process
+    * ``auth.tokens.sweep_batch_size`` - The maximum number of tokens to delete per transaction
+      (default 1000)
 
     The following callbacks can be registered via ``callbacks``:
 
@@ -54,9 +110,23 @@ def init(config, renderers=None, urls=None, redirects=None, callbacks=None):
       :func:`~pywebtools.pyramid.auth.views.forgotten_password`
     * user.validated - called from :func:`~pywebtools.pyramid.auth.views.confirm`
     * user.password_reset - called from :func:`~pywebtools.pyramid.auth.views.forgotten_password`
+    * users.password_reset - called once with all reset users from :func:`~pywebtools.pyramid.auth.views.action`
     * user.password_reset_failed - called from :func:`~pywebtools.pyramid.auth.views.forgotten_password`
     * user.password_reset_complete - called from :func:`~pywebtools.pyramid.auth.views.reset_password`
 
+    The search index used to find users (see :mod:`~pywebtools.pyramid.auth.search`) is
+    selected via the ``auth.users.search`` setting: "auto" (default), "trigram", or "like".
+    If the ``DBSession`` is already bound to an engine, then the trigram table is created here.
+
+    The user autocomplete (see :mod:`~pywebtools.pyramid.auth.autocomplete`) is configured via
+    the ``auth.autocomplete.max_results`` and ``auth.autocomplete.reload_interval`` settings.
+
+    If ``auth.outbox.enabled`` is set to "true", then the callbacks are recorded in the
+    same transaction as the changes they relate to and are dispatched outside of the request
+    (see :mod:`~pywebtools.pyramid.auth.outbox` for the available settings). No worker threads
+    are started, use :func:`~pywebtools.pyramid.auth.outbox.start_workers` or the
+    "pywebtools-dispatch-outbox" console script to dispatch the callbacks.
+
     :param config: The Pyramid configuration object to use to set up the configuration
     :type config: :class:`~pyramid.config.Configurator`
     :param renderers: Renderers to attach to the available views
@@ -74,6 +144,35 @@ def init(config, renderers=None, urls=None, redirects=None, callbacks=None):
         views.active_redirects.update(redirects)
     if callbacks:
         views.active_callbacks.update(callbacks)
+    config.add_request_method(get_current_user, 'current_user', reify=True)
+    settings = config.get_settings()
+    passwords.configure(hasher=settings.get('auth.password.hasher'),
+                        cost=convert_type(settings.get('auth.password.cost', ''), 'int'),
+                        target_ms=convert_type(settings.get('auth.password.target_ms', ''), 'int'),
+                        workers=convert_type(settings.get('auth.password.workers', ''), 'int', default=0),
+                        max_pending=convert_type(settings.get('auth.password.max_pending', ''), 'int', default=0))
+    backend = settings.get('auth.tokens.backend', 'database')
+    if backend == 'signed':
+        if not settings.get('auth.tokens.secret'):
+            raise ConfigurationError('auth.tokens.secret must be set to use signed tokens')
+        tokens.active_backend = tokens.SignedTokenBackend(settings['auth.tokens.secret'])
+    elif backend == 'database':
+        tokens.active_backend = tokens.DatabaseTokenBackend()
+    else:
+        raise ConfigurationError('Unknown token backend %s' % backend)
+    permission_group_catalog.ttl = convert_type(settings.get('auth.permissions.catalog_ttl', ''), 'int', default=1)
+    try:
+        bind = DBSession.get_bind()
+    except UnboundExecutionError:
+        bind = None
+    search.configure(settings.get('auth.users.search', 'auto'), bind=bind)
+    if convert_type(settings.get('auth.outbox.enabled', ''), 'boolean'):
+        max_attempts = convert_type(settings.get('auth.outbox.max_attempts', ''), 'int', default=5)
+        retry_delay = convert_type(settings.get('auth.outbox.retry_delay', ''), 'int', default=60)
+        outbox.active_outbox = outbox.CallbackOutbox(config.registry, views.active_callbacks,
+                                                     max_attempts=max_attempts, retry_delay=retry_delay)
+    else:
+        outbox.active_outbox = None
     for key in routes:
         config.add_route(key, active_urls[key])
     for key in active_urls.keys():
@@ -81,3 +180,6 @@ def init(config, renderers=None, urls=None, redirects=None, callbacks=None):
             config.add_view('pywebtools.pyramid.auth.views.%s' % (key.split('.')[-1]),
                             route_name=key,
                             renderer=renderers[key])
+        elif key in streaming_routes:
+            config.add_view('pywebtools.pyramid.auth.views.%s' % (key.split('.')[-1]),
+                            route_name=key)
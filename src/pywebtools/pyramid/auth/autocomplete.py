@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+#################################################################
+:mod:`pywebtools.pyramid.auth.autocomplete` -- User Autocomplete
+#################################################################
+
+The :mod:`~pywebtools.pyramid.auth.autocomplete` module provides the in-process
+:class:`~pywebtools.pyramid.auth.autocomplete.PrefixIndex` used by the
+:func:`~pywebtools.pyramid.auth.views.autocomplete` view to find users by the start of their
+display name, any word in their display name, or their e-mail address, without querying the
+database.
+
+The index is loaded from the database on first use and is then updated whenever a
+:class:`~pywebtools.pyramid.auth.models.User` is added, changed, or deleted and the change
+has been committed. Changes made in other processes only become visible when the index is
+reloaded.
+
+The index is configured via the following settings in the [app:main] section of the
+INI file:
+
+* ``auth.autocomplete.max_results`` -- The maximum number of users returned per request
+  (default 10).
+* ``auth.autocomplete.reload_interval`` -- The number of seconds after which the index is
+  reloaded from the database. If not set or 0, then the index is never reloaded.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import bisect
+import heapq
+import threading
+import time
+
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import object_session, Session
+
+from pywebtools.pyramid.auth.models import User
+from pywebtools.pyramid.util import get_config_setting
+
+
+IndexedUser = namedtuple('IndexedUser', ['id', 'display_name', 'email'])
+"""The values of a :class:`~pywebtools.pyramid.auth.models.User` stored in the
+:class:`~pywebtools.pyramid.auth.autocomplete.PrefixIndex`."""
+
+
+class PrefixIndex(object):
+    """The :class:`~pywebtools.pyramid.auth.autocomplete.PrefixIndex` is a thread-safe, sorted list
+    of lower-cased keys, that supports finding all users with a key that starts with a given
+    prefix via binary search.
+
+    Keys of added or changed users are inserted into a small, separate sorted list and keys of
+    removed users are only marked as stale, so that changes do not shift the whole list. Once
+    ``merge_threshold`` keys have been added or marked as stale, the two lists are merged and
+    the stale keys dropped.
+    """
+
+    def __init__(self, merge_threshold=1000):
+        """
+        :param merge_threshold: The number of added and stale keys after which the lists are merged
+        :type merge_threshold: ``int``
+        """
+        self.merge_threshold = merge_threshold
+        self._keys = []
+        self._added = []
+        self._stale = 0
+        self._users = {}
+        self._user_keys = {}
+        self._lock = threading.Lock()
+        self.loaded = None
+
+    def load(self, dbsession):
+        """Replace the indexed users with all users from the database.
+
+        :param dbsession: The database session to load the users with
+        """
+        users = {}
+        user_keys = {}
+        keys = []
+        for row in dbsession.query(User.id, User.display_name, User.email):
+            user = IndexedUser(*row)
+            users[user.id] = user
+            user_keys[user.id] = self._keys_for(user)
+            keys.extend((key, user.id) for key in user_keys[user.id])
+        keys.sort()
+        with self._lock:
+            self._users = users
+            self._user_keys = user_keys
+            self._keys = keys
+            self._added = []
+            self._stale = 0
+            self.loaded = time.monotonic()
+
+    def _keys_for(self, user):
+        """Returns the keys the ``user`` can be found by."""
+        keys = set()
+        if user.display_name:
+            name = user.display_name.lower()
+            keys.add(name)
+            keys.update(name.split()[1:])
+        if user.email:
+            keys.add(user.email.lower())
+        return frozenset(keys)
+
+    def update(self, user):
+        """Add or update the entry for the ``user``.
+
+        :param user: The user's values
+        :type user: :class:`~pywebtools.pyramid.auth.autocomplete.IndexedUser`
+        """
+        with self._lock:
+            self._remove(user.id)
+            keys = self._keys_for(user)
+            self._users[user.id] = user
+            self._user_keys[user.id] = keys
+            for key in keys:
+                bisect.insort(self._added, (key, user.id))
+            self._merge()
+
+    def remove(self, user_id):
+        """Remove the entry for the user with the ``user_id``.
+
+        :param user_id: The identifier of the user to remove
+        :type user_id: ``int``
+        """
+        with self._lock:
+            self._remove(user_id)
+            self._merge()
+
+    def _remove(self, user_id):
+        """Mark the keys of the ``user_id`` as stale. Must be called with the lock held."""
+        if user_id in self._users:
+            del self._users[user_id]
+            self._stale = self._stale + len(self._user_keys.pop(user_id))
+
+    def _merge(self):
+        """Merge the added keys into the sorted keys and drop the stale keys, once there are
+        ``merge_threshold`` of them. Must be called with the lock held.
+        """
+        if len(self._added) + self._stale >= self.merge_threshold:
+            keys = []
+            for entry in heapq.merge(self._keys, self._added):
+                if entry[0] in self._user_keys.get(entry[1], ()) and (not keys or keys[-1] != entry):
+                    keys.append(entry)
+            self._keys = keys
+            self._added = []
+            self._stale = 0
+
+    def _entries(self, keys, prefix):
+        """Returns the entries of the sorted ``keys`` from the first one that is not less than
+        the ``prefix`` onwards.
+        """
+        for idx in range(bisect.bisect_left(keys, (prefix, )), len(keys)):
+            yield keys[idx]
+
+    def search(self, prefix, limit=None):
+        """Find the users with a key that starts with the ``prefix``, in key order. Each user
+        is only returned once.
+
+        :param prefix: The prefix to search for
+        :type prefix: `unicode`
+        :param limit: The maximum number of users to return. If ``None``, all matching users
+                      are returned
+        :type limit: ``int``
+        :return: The matching users
+        :rtype: ``list`` of :class:`~pywebtools.pyramid.auth.autocomplete.IndexedUser`
+        """
+        prefix = prefix.lower()
+        matches = []
+        seen = set()
+        with self._lock:
+            for key, user_id in heapq.merge(self._entries(self._keys, prefix), self._entries(self._added, prefix)):
+                if not key.startswith(prefix):
+                    break
+                if user_id not in seen and key in self._user_keys.get(user_id, ()):
+                    seen.add(user_id)
+                    matches.append(self._users[user_id])
+                    if limit is not None and len(matches) >= limit:
+                        break
+        return matches
+
+    def find(self, user_id, prefix):
+        """Check whether the user with the ``user_id`` has a key that starts with the ``prefix``.
+
+        :param user_id: The identifier of the user to check
+        :type user_id: ``int``
+        :param prefix: The prefix to search for
+        :type prefix: `unicode`
+        :return: The user or ``None`` if the user does not exist or does not match
+        :rtype: :class:`~pywebtools.pyramid.auth.autocomplete.IndexedUser`
+        """
+        prefix = prefix.lower()
+        with self._lock:
+            if any(key.startswith(prefix) for key in self._user_keys.get(user_id, ())):
+                return self._users[user_id]
+        return None
+
+
+# The process-wide prefix index. None if it has not been loaded.
+active_index = None
+_load_lock = threading.Lock()
+
+
+def get_autocomplete_index(request, dbsession):
+    """Get the process-wide :class:`~pywebtools.pyramid.auth.autocomplete.PrefixIndex`, loading
+    it from the database on first access or when the ``auth.autocomplete.reload_interval``
+    has passed.
+
+    :param request: The request used to access the configuration settings
+    :type request: :class:`~pyramid.request.Request`
+    :param dbsession: The database session to load the users with
+    :return: The prefix index
+    :rtype: :class:`~pywebtools.pyramid.auth.autocomplete.PrefixIndex`
+    """
+    global active_index
+    reload_interval = get_config_setting(request, 'auth.autocomplete.reload_interval', target_type='int',
+                                         default=0)
+    if active_index is None or (reload_interval and time.monotonic() - active_index.loaded > reload_interval):
+        with _load_lock:
+            if active_index is None or (reload_interval and
+                                        time.monotonic() - active_index.loaded > reload_interval):
+                index = active_index or PrefixIndex()
+                index.load(dbsession)
+                active_index = index
+    return active_index
+
+
+def record_removed(session, user_ids):
+    """Record that the users with the ``user_ids`` have been deleted without loading them into
+    the ``session``. They are removed from the index once the ``session`` commits.
+
+    :param session: The session the users were deleted in
+    :param user_ids: The identifiers of the deleted users
+    :type user_ids: ``list`` of ``int``
+    """
+    session.info.setdefault('pywebtools.autocomplete', []).extend((user_id, None) for user_id in user_ids)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _user_changed(mapper, connection, target):
+    """Records the changed :class:`~pywebtools.pyramid.auth.models.User` values, to be applied to
+    the index once the session commits.
+    """
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('pywebtools.autocomplete', []).append(
+            (target.id, IndexedUser(target.id, target.display_name, target.email)))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    """Records the deleted :class:`~pywebtools.pyramid.auth.models.User`, to be removed from the
+    index once the session commits.
+    """
+    session = object_session(target)
+    if session is not None:
+        record_removed(session, [target.id])
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    """Applies the recorded changes to the index after the session has committed."""
+    changes = session.info.pop('pywebtools.autocomplete', None)
+    if changes and active_index is not None:
+        for user_id, user in changes:
+            if user is None:
+                active_index.remove(user_id)
+            else:
+                active_index.update(user)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    """Discards the recorded changes if the session is rolled back."""
+    session.info.pop('pywebtools.autocomplete', None)
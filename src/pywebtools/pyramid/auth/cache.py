@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+###############################################################
+:mod:`pywebtools.pyramid.auth.cache` -- Logged-in User Caching
+###############################################################
+
+The :mod:`~pywebtools.pyramid.auth.cache` module provides an optional, process-wide
+cache of :class:`~pywebtools.pyramid.auth.models.User` snapshots, which removes the
+primary-key lookup of the current user from most authenticated requests.
+
+The cache is configured via the following settings in the [app:main] section of the
+INI file:
+
+* ``auth.user_cache.size`` -- The maximum number of users to cache. If not set or 0,
+  then the cache is disabled.
+* ``auth.user_cache.ttl`` -- The number of seconds a cached user is valid for
+  (default 300).
+
+The cache is invalidated by the user management views whenever they change a
+:class:`~pywebtools.pyramid.auth.models.User`. As the cache is per-process, changes made
+in other processes only become visible once the cached entry's TTL has expired.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import copy
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from pywebtools.pyramid.auth.models import User, load_user, permission_group_catalog
+from pywebtools.pyramid.util import get_config_setting
+
+
+class UserCache(object):
+    """The :class:`~pywebtools.pyramid.auth.cache.UserCache` is a thread-safe, bounded LRU
+    cache with a time-to-live, that stores detached snapshots of
+    :class:`~pywebtools.pyramid.auth.models.User` column values keyed by the user's id. If
+    the user's effective permissions have been loaded, then these are cached as well, in the
+    form of the user's :attr:`~pywebtools.pyramid.auth.models.User.permission_mask`. Entries
+    with a mask are re-loaded once the version of the
+    :data:`~pywebtools.pyramid.auth.models.permission_group_catalog` differs from the one
+    the mask was computed with, as the permissions of the user's groups may have changed.
+    """
+
+    def __init__(self, size, ttl):
+        """Construct a new :class:`~pywebtools.pyramid.auth.cache.UserCache`.
+
+        :param size: The maximum number of cached users
+        :type size: ``int``
+        :param ttl: The number of seconds a cached user is valid for
+        :type ttl: ``int``
+        """
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dbsession, uid, permissions=False):
+        """Get the :class:`~pywebtools.pyramid.auth.models.User` with the given ``uid``. If
+        there is a valid snapshot in the cache, then it is merged into the ``dbsession``
+        without querying the database. Otherwise the user is loaded from the database and
+        a snapshot stored in the cache.
+
+        :param dbsession: The database session to load the user into
+        :param uid: The user's identifier
+        :type uid: ``int``
+        :param permissions: Whether to load the user's effective permissions together with the user
+        :type permissions: ``bool``
+        :return: The user or ``None`` if no user exists with the given ``uid``
+        :rtype: :class:`~pywebtools.pyramid.auth.models.User`
+        """
+        entry = self._lookup(uid)
+        if entry is not None and (entry[1] is None or
+                                  entry[2] == permission_group_catalog.current_version(dbsession)):
+            values, mask, version = entry
+            user = User(**copy.deepcopy(values))
+            make_transient_to_detached(user)
+            user = dbsession.merge(user, load=False)
+            if mask is not None:
+                user.set_permission_mask(mask, version)
+            return user
+        user = load_user(dbsession, uid, permissions=permissions)
+        if user is not None:
+            self.store(user)
+        return user
+
+    def store(self, user):
+        """Store a snapshot of the given ``user`` in the cache, evicting the least recently
+        used entry if the cache is full.
+
+        :param user: The user to store
+        :type user: :class:`~pywebtools.pyramid.auth.models.User`
+        """
+        values = {}
+        for attr in inspect(User).column_attrs:
+            value = getattr(user, attr.key)
+            if isinstance(value, (dict, list)):
+                value = json.loads(json.dumps(value))
+            values[attr.key] = value
+        mask = user.permission_mask if '_permissions' in user.__dict__ else None
+        version = user.__dict__.get('_permissions_version')
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, (values, mask, version))
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, uid=None):
+        """Remove the user with the given ``uid`` from the cache. If ``uid`` is ``None``,
+        then the whole cache is cleared.
+
+        :param uid: The identifier of the user to remove
+        :type uid: ``int``
+        """
+        with self._lock:
+            if uid is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(uid, None)
+
+    def _lookup(self, uid):
+        """Get the cached values and permission mask for the given ``uid``, if they exist and have
+        not expired.
+        """
+        with self._lock:
+            if uid in self._entries:
+                timeout, entry = self._entries[uid]
+                if timeout >= time.monotonic():
+                    self._entries.move_to_end(uid)
+                    return entry
+                else:
+                    del self._entries[uid]
+        return None
+
+
+# The process-wide user cache. Set to False if caching is disabled.
+active_cache = None
+
+
+def get_user_cache(request):
+    """Get the process-wide :class:`~pywebtools.pyramid.auth.cache.UserCache`, creating it
+    from the configuration settings on first access.
+
+    :param request: The request used to access the configuration settings
+    :type request: :class:`~pyramid.request.Request`
+    :return: The user cache or ``None`` if caching is disabled
+    :rtype: :class:`~pywebtools.pyramid.auth.cache.UserCache`
+    """
+    global active_cache
+    if active_cache is None:
+        size = get_config_setting(request, 'auth.user_cache.size', target_type='int', default=0)
+        if size:
+            active_cache = UserCache(size,
+                                     get_config_setting(request, 'auth.user_cache.ttl',
+                                                        target_type='int', default=300))
+        else:
+            active_cache = False
+    return active_cache or None
+
+
+def invalidate_user(uid=None):
+    """Remove the user with the given ``uid`` from the process-wide cache, if caching is
+    enabled. If ``uid`` is ``None``, then all cached users are removed.
+
+    :param uid: The identifier of the user to remove
+    :type uid: ``int``
+    """
+    if active_cache:
+        active_cache.invalidate(uid)
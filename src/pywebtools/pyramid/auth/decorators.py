@@ -13,8 +13,9 @@ from decorator import decorator
 
 from pyramid.httpexceptions import HTTPNotFound, HTTPSeeOther
 
-from pywebtools.pyramid.auth.models import User
-from pywebtools.pyramid.util import request_from_args
+from pywebtools.pyramid.auth.cache import get_user_cache
+from pywebtools.pyramid.auth.models import User, load_user
+from pywebtools.pyramid.util import get_config_setting, request_from_args
 from pywebtools.sqlalchemy import DBSession
 
 
@@ -50,32 +51,59 @@ def unauthorised_redirect(request, redirect_to=None, message=None):
         raise HTTPSeeOther(request.route_url('user.login', _query={'return_to': request.current_route_url()}))
 
 
+def get_current_user(request):
+    """Loads the currently logged in :class:`~pywebtools.pyramid.auth.models.User`, using the
+    user identifier stored in the session. If there is no logged in user, then an anonymous
+    :class:`~pywebtools.pyramid.auth.models.User` is returned.
+
+    This is registered by :func:`~pywebtools.pyramid.auth.init` as the reified request
+    method ``current_user``, so that the user is loaded at most once per request. If the
+    :class:`~pywebtools.pyramid.auth.cache.UserCache` is enabled, then the user is loaded
+    via the cache.
+
+    If the ``auth.permissions.eager`` configuration setting is "true", then the user's
+    effective permissions are loaded in the same query as the user.
+
+    :param request: The pyramid request
+    :return: The current user
+    :rtype: :class:`~pywebtools.pyramid.auth.models.User`
+    """
+    if 'uid' in request.session:
+        dbsession = DBSession()
+        permissions = get_config_setting(request, 'auth.permissions.eager', target_type='boolean', default=False)
+        cache = get_user_cache(request)
+        if cache:
+            user = cache.get(dbsession, request.session['uid'], permissions=permissions)
+        else:
+            user = load_user(dbsession, request.session['uid'], permissions=permissions)
+        if user:
+            user.logged_in = True
+            return user
+    user = User()
+    user.logged_in = False
+    return user
+
+
 def current_user():
-    """Inserts the currently logged in :class:`~pywebtools.pyramid.auth.models.User` into the
-    `request` parameter under the attribute ``current_user``. If there is no
+    """Ensures that the currently logged in :class:`~pywebtools.pyramid.auth.models.User` is
+    available in the `request` parameter under the attribute ``current_user``. If there is no
     logged in user, then an anonymous :class:`~pywebtools.pyramid.auth.models.User` is created.
 
+    If the ``current_user`` request method has been registered via :func:`~pywebtools.pyramid.auth.init`,
+    then the already loaded user is re-used, otherwise it is loaded using
+    :func:`~pywebtools.pyramid.auth.decorators.get_current_user`.
+
     Used in view functions.
     """
     def wrapper(f, *args, **kwargs):
         request = request_from_args(*args)
-        if 'uid' in request.session:
-            dbsession = DBSession()
-            user = dbsession.query(User).filter(User.id == request.session['uid']).first()
-            if user:
-                user.logged_in = True
-                request.current_user = user
-            else:
-                request.current_user = User()
-                request.current_user.logged_in = False
-        else:
-            request.current_user = User()
-            request.current_user.logged_in = False
+        if not hasattr(request, 'current_user'):
+            request.current_user = get_current_user(request)
         return f(*args, **kwargs)
     return decorator(wrapper)
 
 
-def require_permission(permission=None, class_=None, request_key=None, action=None):
+def require_permission(permission=None, class_=None, request_key=None, action=None, options=None):
     """Checks whether the current user has the given permission. Supports two modes:
 
     If you provide the ``permission`` parameter and it will use
@@ -89,7 +117,10 @@ def require_permission(permission=None, class_=None, request_key=None, action=No
     will use the ``class_``\ 's ``allow`` to check whether the current user is allowed
     to perform the given ``action``. If not  it raises
     :class:`~pyramid.httpexceptions.HTTPUnauthorised`. If no result is returned then it
-    will raise :class:`~pyramid.httpexceptions.HTTPNotFound`.
+    will raise :class:`~pyramid.httpexceptions.HTTPNotFound`. The loaded instance is
+    stored in the request as ``request.context_object``, so that the view does not need
+    to query for it again. Any SQLAlchemy loader ``options`` (for example
+    :func:`~sqlalchemy.orm.joinedload`) are applied to the query.
 
     :param permission: The permission to check the user for
     :type permission: ``str``
@@ -101,6 +132,8 @@ def require_permission(permission=None, class_=None, request_key=None, action=No
     :type request_key: ``str``
     :param action: The action to check for with the instance of ``class_``
     :type action: ``str``
+    :param options: The loader options to apply when querying for the instance of ``class_``
+    :type options: ``list``
     :return: The decorated function's return value
     """
     def wrapper(f, *args, **kwargs):
@@ -111,9 +144,13 @@ def require_permission(permission=None, class_=None, request_key=None, action=No
                     return f(*args, **kwargs)
                 else:
                     unauthorised_redirect(request)
-            elif object is not None and request_key is not None and action is not None:
+            elif class_ is not None and request_key is not None and action is not None:
                 dbsession = DBSession()
-                instance = dbsession.query(class_).filter(class_.id == request.matchdict[request_key]).first()
+                query = dbsession.query(class_)
+                if options:
+                    query = query.options(*options)
+                instance = query.filter(class_.id == request.matchdict[request_key]).first()
+                request.context_object = instance
                 if instance is not None:
                     if instance.allow(action, request.current_user):
                         return f(*args, **kwargs)
@@ -11,15 +11,18 @@ interest are the :class:`~pywebtools.pyramid.auth.models.User` and
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-import hashlib
 import json
 import random
+import threading
+import time
 
 from sqlalchemy import (Table, Column, Index, ForeignKey, Integer, Unicode,
-                        DateTime, UnicodeText)
-from sqlalchemy.orm import (relationship, reconstructor, backref)
+                        DateTime, UnicodeText, and_, event, false, null, select, true, union_all)
+from sqlalchemy.orm import (relationship, reconstructor, backref, object_session, Session)
 from uuid import uuid4
+from zope.sqlalchemy import mark_changed
 
+from pywebtools.pyramid.auth import passwords
 from pywebtools.pyramid.util import MenuBuilder, confirm_delete
 from pywebtools.sqlalchemy import Base, DBSession, JSONUnicodeText, MutableDict
 
@@ -44,6 +47,106 @@ def init_auth_permissions(dbsession):
     return group
 
 
+def permission_grants(user_ids):
+    """Creates a query that lists the permissions granted directly to the users with the
+    given ``user_ids`` and the :class:`~pywebtools.pyramid.auth.models.PermissionGroup` that
+    they belong to. Each row either has the ``name`` or the ``permission_group_id`` set. The
+    groups' permissions are expanded via the
+    :data:`~pywebtools.pyramid.auth.models.permission_group_catalog`.
+
+    :param user_ids: The identifiers of the users to list the grants for
+    :type user_ids: ``list`` of ``int``
+    :return: The query with the three columns ``user_id``, ``name``, and ``permission_group_id``
+    :rtype: :class:`~sqlalchemy.sql.expression.CompoundSelect`
+    """
+    direct_perm = select([users_permissions.c.user_id.label('user_id'),
+                          Permission.name.label('name'),
+                          null().label('permission_group_id')]).\
+        select_from(users_permissions.join(Permission, users_permissions.c.permission_id == Permission.id)).\
+        where(users_permissions.c.user_id.in_(user_ids))
+    group_perm = select([users_groups.c.user_id.label('user_id'),
+                         null().label('name'),
+                         users_groups.c.permission_group_id.label('permission_group_id')]).\
+        where(users_groups.c.user_id.in_(user_ids))
+    return union_all(direct_perm, group_perm)
+
+
+def effective_permissions(dbsession, user_ids):
+    """Loads the effective permissions for the users with the given ``user_ids``, both those
+    granted directly and those granted via a :class:`~pywebtools.pyramid.auth.models.PermissionGroup`,
+    in a single query.
+
+    :param dbsession: The database session to use
+    :param user_ids: The identifiers of the users to load the permissions for
+    :type user_ids: ``list`` of ``int``
+    :return: The permission names for each user identifier
+    :rtype: ``dict`` of ``int`` to ``frozenset`` of `unicode`
+    """
+    names = dict((uid, set()) for uid in user_ids)
+    groups = permission_group_catalog.get(dbsession)
+    for uid, name, group_id in dbsession.execute(permission_grants(user_ids)):
+        if name is not None:
+            names[uid].add(name)
+        elif group_id in groups:
+            names[uid].update(groups[group_id])
+    return dict((uid, frozenset(value)) for uid, value in names.items())
+
+
+def allow_many(action, instances, user):
+    """Checks whether the given ``user`` is allowed to perform the given ``action`` on each of
+    the ``instances``. If the ``instances``' class provides an ``allow_many`` class method
+    with the same signature, then that is used to compute all decisions at once. Otherwise
+    the instances' ``allow`` method is called for each instance.
+
+    :param action: The action to check for
+    :type action: `unicode`
+    :param instances: The instances to check
+    :type instances: ``list``
+    :param user: The user to check
+    :type user: :class:`~pywebtools.pyramid.auth.models.User`
+    :return: The decision for each instance's ``id``
+    :rtype: ``dict`` of ``int`` to ``bool``
+    """
+    instances = list(instances)
+    if instances and hasattr(type(instances[0]), 'allow_many'):
+        return type(instances[0]).allow_many(action, instances, user)
+    return dict((instance.id, instance.allow(action, user)) for instance in instances)
+
+
+def load_user(dbsession, uid, permissions=False):
+    """Loads the :class:`~pywebtools.pyramid.auth.models.User` with the given ``uid``. If
+    ``permissions`` is ``True``, then the user's effective permissions are loaded in the same
+    query, so that :func:`~pywebtools.pyramid.auth.models.User.has_permission` does not need
+    to query the database.
+
+    :param dbsession: The database session to load the user with
+    :param uid: The identifier of the user to load
+    :type uid: ``int``
+    :param permissions: Whether to also load the user's effective permissions
+    :type permissions: ``bool``
+    :return: The user or ``None`` if no user with the ``uid`` exists
+    :rtype: :class:`~pywebtools.pyramid.auth.models.User`
+    """
+    if permissions:
+        grants = permission_grants([uid]).alias()
+        version, groups = permission_group_catalog.snapshot(dbsession)
+        user = None
+        names = set()
+        for user, name, group_id in dbsession.query(User, grants.c.name, grants.c.permission_group_id).\
+                outerjoin(grants, grants.c.user_id == User.id).filter(User.id == uid):
+            if name is not None:
+                names.add(name)
+            elif group_id in groups:
+                names.update(groups[group_id])
+        if user is not None:
+            user.__dict__.pop('_permission_mask', None)
+            user._permissions = frozenset(names)
+            user._permissions_version = version
+        return user
+    else:
+        return dbsession.query(User).get(uid)
+
+
 class User(Base):
     """The :class:`~pywebtools.pyramid.auth.models.User` represents a generic user. Which
     functionality they can access is determined purely through the individual
@@ -75,7 +178,7 @@ class User(Base):
     display_name = Column(Unicode(64))
     login_limit = Column(Integer)
     status = Column(Unicode(255))
-    options = Column(MutableDict.as_mutable(JSONUnicodeText))
+    options = Column(MutableDict.as_mutable(JSONUnicodeText(lazy=True)))
 
     permissions = relationship('Permission', backref='users', secondary='users_permissions')
     permission_groups = relationship('PermissionGroup', backref='users', secondary='users_permission_groups')
@@ -104,13 +207,14 @@ class User(Base):
     def new_password(self, password):
         """Sets the given ``password`` as the :class:`~pywebtools.pyramid.auth.models.User`'s new
         password. Calls :func:`~pywebtools.pyramid.auth.models.User.new_salt` to generate a new
-        salt for the password.
+        salt for the password, which is then hashed via
+        :func:`~pywebtools.pyramid.auth.passwords.hash_password`.
 
         :param password: The new cleartext password
         :type password: `unicode`
         """
         self.new_salt()
-        self.password = str(hashlib.sha512(('%s$$%s' % (self.salt, password)).encode('utf-8')).hexdigest())
+        self.password = passwords.hash_password(password, self.salt)
 
     def password_matches(self, password):
         """Checks whether the given password matches the hashed, stored
@@ -121,27 +225,76 @@ class User(Base):
         :return: ``True`` if the passwords match, ``False`` otherwise
         :rtype: `bool`
         """
-        password = str(hashlib.sha512(('%s$$%s' % (self.salt, password)).encode('utf-8')).hexdigest())
-        return password == self.password
+        return passwords.verify_password(password, self.salt, self.password)
+
+    def password_needs_rehash(self):
+        """Checks whether the stored password was hashed with different parameters than
+        the currently configured password hasher uses.
+
+        :return: ``True`` if the password should be re-hashed, ``False`` otherwise
+        :rtype: `bool`
+        """
+        return passwords.needs_rehash(self.password)
 
     def has_permission(self, permission):
         """Checks whether the user has been granted the given ``permission``,
         either directly or via a :class:`~pywebtools.pyramid.auth.models.PermissionGroup`.
 
+        The ``permission`` can also be a bitmask created via the
+        :data:`~pywebtools.pyramid.auth.models.permission_registry`, in which case the user
+        must have all permissions in the bitmask.
+
         :param permission: The permission to check for
-        :type permission: `unicode`
+        :type permission: `unicode` or ``int``
         :return: ``True`` if the user has the permission, ``False`` otherwise
         :rtype: `bool`
         """
-        if hasattr(self, '_permissions'):
-            return permission in self._permissions
+        if isinstance(permission, int):
+            return permission != 0 and self.permission_mask & permission == permission
+        if not hasattr(self, '_permissions'):
+            self.load_permissions()
+        return permission in self._permissions
+
+    @property
+    def permission_mask(self):
+        """The bitmask of the user's effective permissions, as defined by the
+        :data:`~pywebtools.pyramid.auth.models.permission_registry`.
+        """
+        if not hasattr(self, '_permission_mask'):
+            if not hasattr(self, '_permissions'):
+                self.load_permissions()
+            self._permission_mask = permission_registry.mask(self._permissions)
+        return self._permission_mask
+
+    def set_permission_mask(self, mask, version=None):
+        """Sets the user's effective permissions from the given bitmask, for example when
+        restoring the user from a cache.
+
+        :param mask: The permissions bitmask
+        :type mask: ``int``
+        :param version: The :data:`~pywebtools.pyramid.auth.models.permission_group_catalog`
+                        version the bitmask was computed with
+        :type version: ``int``
+        """
+        self._permission_mask = mask
+        self._permissions = permission_registry.names(mask)
+        self._permissions_version = version
+
+    def load_permissions(self):
+        """Loads the names of all permissions the user has been granted, either directly or
+        via a :class:`~pywebtools.pyramid.auth.models.PermissionGroup`, in a single query.
+
+        :return: The names of the user's effective permissions
+        :rtype: ``frozenset`` of `unicode`
+        """
+        self.__dict__.pop('_permission_mask', None)
+        # Version the permissions are at least as new as, as the catalog may be re-loaded
+        self._permissions_version = permission_group_catalog.snapshot()[0]
+        if self.id is None:
+            self._permissions = frozenset()
         else:
-            dbsession = DBSession()
-            direct_perm = dbsession.query(Permission.name).join(User, Permission.users).filter(User.id == self.id)
-            group_perm = dbsession.query(Permission.name).join(PermissionGroup, Permission.permission_groups).\
-                join(User, PermissionGroup.users).filter(User.id == self.id)
-            self._permissions = [p[0] for p in direct_perm.union(group_perm)]
-            return self.has_permission(permission)
+            self._permissions = effective_permissions(DBSession(), [self.id])[self.id]
+        return self._permissions
 
     def allow(self, action, user):
         """Checks whether the given ``user`` is allowed to perform the given
@@ -171,48 +324,112 @@ class User(Base):
             return user.has_permission('admin.users.delete')
         return False
 
+    @classmethod
+    def allow_many(cls, action, users, user):
+        """Checks whether the given ``user`` is allowed to perform the given ``action`` on each
+        of the ``users``. The ``user``'s permissions are only checked once for all ``users``.
+        Supports the same actions as :func:`~pywebtools.pyramid.auth.models.User.allow`.
+
+        :param action: The action to check for
+        :type action: `unicode`
+        :param users: The users to check the action for
+        :type users: ``list`` of :class:`~pywebtools.pyramid.auth.models.User`
+        :param user: The user to check
+        :type user: :class:`~pywebtools.pyramid.auth.models.User`
+        :return: The decision for each of the ``users``' ``id``
+        :rtype: ``dict`` of ``int`` to ``bool``
+        """
+        if action in ['view', 'edit', 'delete']:
+            allowed = user.has_permission('admin.users.%s' % action)
+            return dict((other.id, allowed or other.id == user.id) for other in users)
+        elif action == 'edit-permissions':
+            allowed = user.has_permission('admin.users.permissions')
+            return dict((other.id, allowed) for other in users)
+        return dict((other.id, False) for other in users)
+
+    @classmethod
+    def allow_filter(cls, action, user):
+        """Returns a filter expression that restricts a query to the users on which the given
+        ``user`` is allowed to perform the given ``action``. Supports the same actions as
+        :func:`~pywebtools.pyramid.auth.models.User.allow`.
+
+        :param action: The action to check for
+        :type action: `unicode`
+        :param user: The user to check
+        :type user: :class:`~pywebtools.pyramid.auth.models.User`
+        :return: The filter expression
+        """
+        if action in ['view', 'edit', 'delete']:
+            if user.has_permission('admin.users.%s' % action):
+                return true()
+            return cls.id == user.id
+        elif action == 'edit-permissions':
+            return true() if user.has_permission('admin.users.permissions') else false()
+        return false()
+
     def admin_menu(self, request):
         """Generates the menu bar for the users administration list."""
-        builder = MenuBuilder()
-        if self.allow('edit', request.current_user):
-            if self.status == 'active':
-                builder.group('Edit', 'fi-pencil')
-                builder.menu('Edit',
-                             request.route_url('user.edit', uid=self.id),
-                             icon='fi-pencil',
-                             highlight=True)
-                builder.group('Access', 'fi-key')
-                builder.menu('Edit Permissions',
-                             request.route_url('user.permissions', uid=self.id),
-                             icon='fi-key',
-                             highlight=True)
-                builder.menu('Reset Password',
-                             request.route_url('user.forgotten_password',
-                                               _query=[('email', self.email),
-                                                       ('csrf_token', request.session.get_csrf_token()),
-                                                       ('return_to', request.current_route_url())]),
-                             attrs={'data-post-link': ''})
-            else:
-                builder.group('Access', 'fi-key')
-                builder.menu('Validate user',
-                             request.route_url('users.action', _query=[('user_id', self.id),
-                                                                       ('action', 'validate'),
-                                                                       ('csrf_token',
-                                                                        request.session.get_csrf_token())]),
-                             icon='fi-check',
-                             highlight=True,
-                             attrs={'data-post-link': 'post-link'})
-        if self.allow('delete', request.current_user):
-            builder.group('Delete', 'fi-trash')
-            builder.menu('Delete',
-                         request.route_url('user.delete',
-                                           uid=self.id,
-                                           _query={'csrf_token': request.session.get_csrf_token()}),
-                         icon='fi-trash',
-                         attrs={'data-post-link': '',
-                                'class': 'alert',
-                                'data-wte-confirm': confirm_delete('user', self.display_name, False)})
-        return builder.generate()
+        return User.admin_menus([self], request)[self.id]
+
+    @classmethod
+    def admin_menus(cls, users, request):
+        """Generates the menu bars for the users administration list for all ``users`` at
+        once, using :func:`~pywebtools.pyramid.auth.models.User.allow_many` to check the
+        current user's access.
+
+        :param users: The users to generate the menu bars for
+        :type users: ``list`` of :class:`~pywebtools.pyramid.auth.models.User`
+        :param request: The request used to generate URLs
+        :type request: :class:`~pyramid.request.Request`
+        :return: The menu bar for each of the ``users``' ``id``
+        :rtype: ``dict``
+        """
+        allow_edit = cls.allow_many('edit', users, request.current_user)
+        allow_delete = cls.allow_many('delete', users, request.current_user)
+        csrf_token = request.session.get_csrf_token()
+        return_to = request.current_route_url()
+        menus = {}
+        for user in users:
+            builder = MenuBuilder()
+            if allow_edit[user.id]:
+                if user.status == 'active':
+                    builder.group('Edit', 'fi-pencil')
+                    builder.menu('Edit',
+                                 request.route_url('user.edit', uid=user.id),
+                                 icon='fi-pencil',
+                                 highlight=True)
+                    builder.group('Access', 'fi-key')
+                    builder.menu('Edit Permissions',
+                                 request.route_url('user.permissions', uid=user.id),
+                                 icon='fi-key',
+                                 highlight=True)
+                    builder.menu('Reset Password',
+                                 request.route_url('user.forgotten_password',
+                                                   _query=[('email', user.email),
+                                                           ('csrf_token', csrf_token),
+                                                           ('return_to', return_to)]),
+                                 attrs={'data-post-link': ''})
+                else:
+                    builder.group('Access', 'fi-key')
+                    builder.menu('Validate user',
+                                 request.route_url('users.action', _query=[('user_id', user.id),
+                                                                           ('action', 'validate'),
+                                                                           ('csrf_token', csrf_token)]),
+                                 icon='fi-check',
+                                 highlight=True,
+                                 attrs={'data-post-link': 'post-link'})
+            if allow_delete[user.id]:
+                builder.group('Delete', 'fi-trash')
+                builder.menu('Delete',
+                             request.route_url('user.delete',
+                                               uid=user.id,
+                                               _query={'csrf_token': csrf_token}),
+                             icon='fi-trash',
+                             attrs={'data-post-link': '',
+                                    'class': 'alert',
+                                    'data-wte-confirm': confirm_delete('user', user.display_name, False)})
+            menus[user.id] = builder.generate()
+        return menus
 
     def has_option(self, key):
         """Check if the :class:`~pywebtools.pyramid.auth.models.User` has the given option.
@@ -238,6 +455,7 @@ class User(Base):
 
 
 Index('users_email_ix', User.email)
+Index('users_display_name_id_ix', User.display_name, User.id)
 
 
 users_permissions = Table('users_permissions', Base.metadata,
@@ -279,6 +497,102 @@ class Permission(Base):
 Index('permissions_name_ix', Permission.name)
 
 
+class PermissionRegistry(object):
+    """The :class:`~pywebtools.pyramid.auth.models.PermissionRegistry` assigns each
+    :class:`~pywebtools.pyramid.auth.models.Permission` a bit in an integer bitmask, so that
+    sets of permissions can be stored compactly and checked in constant time. The bit
+    positions are assigned consecutively, in the order of the permissions' ``id``, when
+    the permissions are first loaded, so that the size of a bitmask depends on the number of
+    permissions and not on their ``id``. A permission keeps its bit for the lifetime of the
+    process and bits are not re-used, so that bitmasks remain valid when the registry is
+    re-loaded. Bitmasks are not stable between processes and must not be stored outside of
+    the process.
+
+    The registry is loaded from the database on first use or by explicitly calling
+    :func:`~pywebtools.pyramid.auth.models.PermissionRegistry.load` at startup. If an unknown
+    permission name or bit is requested, the registry is re-loaded once to pick up new
+    permissions.
+    """
+
+    def __init__(self):
+        self._bits = None
+        self._all_bits = 0
+        self._positions = {}
+        self._missing = set()
+        self._missing_mask = 0
+        self._lock = threading.Lock()
+
+    def load(self, dbsession=None):
+        """Load the mapping of permission names to bits from the database. Permissions that
+        have not been loaded before are assigned the next free bits.
+
+        :param dbsession: The database session to use. If ``None`` will create a new session.
+        """
+        if dbsession is None:
+            dbsession = DBSession()
+        names = [row[0] for row in dbsession.query(Permission.name).order_by(Permission.id)]
+        with self._lock:
+            bits = {}
+            all_bits = 0
+            for name in names:
+                if name not in self._positions:
+                    self._positions[name] = 1 << len(self._positions)
+                bits[name] = self._positions[name]
+                all_bits = all_bits | bits[name]
+            self._bits = bits
+            self._all_bits = all_bits
+            self._missing = set()
+            self._missing_mask = 0
+
+    def bit(self, name):
+        """Get the bit for the permission with the given ``name``.
+
+        :param name: The name of the permission
+        :type name: `unicode`
+        :return: The bit for the permission or 0 if no such permission exists
+        :rtype: ``int``
+        """
+        if self._bits is None or (name not in self._bits and name not in self._missing):
+            self.load()
+            if name not in self._bits:
+                self._missing.add(name)
+        return self._bits.get(name, 0)
+
+    def mask(self, names):
+        """Get the bitmask that combines the permissions with the given ``names``. As with
+        :func:`~pywebtools.pyramid.auth.models.PermissionRegistry.bit`, the registry is re-loaded
+        for unknown permission names, which are ignored if they still do not exist.
+
+        :param names: The names of the permissions
+        :type names: ``iterable`` of `unicode`
+        :return: The combined bitmask
+        :rtype: ``int``
+        """
+        mask = 0
+        for name in names:
+            mask = mask | self.bit(name)
+        return mask
+
+    def names(self, mask):
+        """Get the names of all permissions that are set in the given ``mask``.
+
+        :param mask: The permissions bitmask
+        :type mask: ``int``
+        :return: The permission names
+        :rtype: ``frozenset`` of `unicode`
+        """
+        if self._bits is None or mask & ~(self._all_bits | self._missing_mask):
+            self.load()
+            self._missing_mask = mask & ~self._all_bits
+        return frozenset(name for name, bit in self._bits.items() if mask & bit)
+
+
+permission_registry = PermissionRegistry()
+""":class:`~pywebtools.pyramid.auth.models.PermissionRegistry` used for all permission
+bitmasks.
+"""
+
+
 class PermissionGroup(Base):
     """The :class:`~pywebtools.pyramid.auth.models.PermissionGroup` groups together one or more
     :class:`~pywebtools.pyramid.auth.models.Permission` for easier administration.
@@ -315,6 +629,159 @@ groups_permissions = Table('permission_groups_permissions', Base.metadata,
 """
 
 
+permission_catalog_version = Table('permission_catalog_version', Base.metadata,
+                                   Column('id', Integer, primary_key=True, autoincrement=False),
+                                   Column('version', Integer, nullable=False))
+""":class:`sqlalchemy.Table` with a single row that holds the version of the
+:class:`~pywebtools.pyramid.auth.models.PermissionGroup` permissions, shared by all processes.
+"""
+
+
+class PermissionGroupCatalog(object):
+    """The :class:`~pywebtools.pyramid.auth.models.PermissionGroupCatalog` is a process-level
+    cache that maps each :class:`~pywebtools.pyramid.auth.models.PermissionGroup`'s ``id`` to
+    the names of the :class:`~pywebtools.pyramid.auth.models.Permission` it contains.
+
+    The catalog's version is stored in the "permission_catalog_version" table and is
+    incremented via :func:`~pywebtools.pyramid.auth.models.PermissionGroupCatalog.bump` in
+    the same transaction that changes a :class:`~pywebtools.pyramid.auth.models.PermissionGroup`'s
+    permissions, renames a :class:`~pywebtools.pyramid.auth.models.Permission`, or deletes
+    either. This happens automatically whenever such changes are flushed via the ORM. Changes
+    made with plain SQL statements require an explicit call to
+    :func:`~pywebtools.pyramid.auth.models.PermissionGroupCatalog.bump`.
+
+    Each process re-checks the version at most every ``ttl`` seconds and re-loads the catalog
+    if it has changed. Changes committed in the same process are picked up immediately.
+    """
+
+    def __init__(self, ttl=1):
+        """
+        :param ttl: The number of seconds between checks of the version in the database. If 0,
+                    the version is checked on every access
+        :type ttl: ``int``
+        """
+        self.ttl = ttl
+        self.version = None
+        self._checked = None
+        self._snapshot = (None, {})
+        self._lock = threading.Lock()
+
+    def bump(self, dbsession=None):
+        """Increment the catalog's version in the database. Must be called within the
+        transaction that changes the permission groups.
+
+        :param dbsession: The database session to use. If ``None`` will create a new session.
+        """
+        if dbsession is None:
+            dbsession = DBSession()
+        table = permission_catalog_version
+        if dbsession.execute(table.update().where(table.c.id == 1).
+                             values(version=table.c.version + 1)).rowcount == 0:
+            dbsession.execute(table.insert().values(id=1, version=1))
+        mark_changed(dbsession)
+
+    def expire(self):
+        """Check the version in the database on next access."""
+        with self._lock:
+            self._checked = None
+
+    def current_version(self, dbsession=None):
+        """Get the catalog's version, checking the database if it has not been checked within
+        the last ``ttl`` seconds.
+
+        :param dbsession: The database session to use. If ``None`` will create a new session.
+        :return: The version
+        :rtype: ``int``
+        """
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self.ttl:
+            if dbsession is None:
+                dbsession = DBSession()
+            table = permission_catalog_version
+            version = dbsession.query(table.c.version).filter(table.c.id == 1).scalar() or 0
+            with self._lock:
+                self.version = version
+                self._checked = now
+        return self.version
+
+    def snapshot(self, dbsession=None):
+        """Get the catalog's version together with the mapping of group ids to permission names,
+        loading the mapping from the database if the version has changed since it was last
+        loaded.
+
+        :param dbsession: The database session to use. If ``None`` will create a new session.
+        :return: The version and the permission names for each group id
+        :rtype: ``tuple`` of ``int`` and ``dict`` of ``int`` to ``frozenset`` of `unicode`
+        """
+        if dbsession is None:
+            dbsession = DBSession()
+        version = self.current_version(dbsession)
+        snapshot = self._snapshot
+        if snapshot[0] != version:
+            groups = {}
+            for group_id, name in dbsession.query(groups_permissions.c.permission_group_id, Permission.name).\
+                    select_from(groups_permissions).\
+                    join(Permission, groups_permissions.c.permission_id == Permission.id):
+                groups.setdefault(group_id, set()).add(name)
+            snapshot = (version, dict((group_id, frozenset(names)) for group_id, names in groups.items()))
+            with self._lock:
+                self._snapshot = snapshot
+        return snapshot
+
+    def get(self, dbsession=None):
+        """Get the mapping of group ids to permission names (see
+        :func:`~pywebtools.pyramid.auth.models.PermissionGroupCatalog.snapshot`).
+
+        :param dbsession: The database session to use. If ``None`` will create a new session.
+        :return: The permission names for each group id
+        :rtype: ``dict`` of ``int`` to ``frozenset`` of `unicode`
+        """
+        return self.snapshot(dbsession)[1]
+
+
+permission_group_catalog = PermissionGroupCatalog()
+""":class:`~pywebtools.pyramid.auth.models.PermissionGroupCatalog` used when loading the
+effective permissions of a :class:`~pywebtools.pyramid.auth.models.User`.
+"""
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_permission_group_catalog(session, flush_context, instances):
+    """Bumps the :data:`~pywebtools.pyramid.auth.models.permission_group_catalog` in the
+    flushed transaction if any :class:`~pywebtools.pyramid.auth.models.Permission` or
+    :class:`~pywebtools.pyramid.auth.models.PermissionGroup` is added, changed, or deleted,
+    and marks the session, so that the catalog is re-checked once the session commits.
+    """
+    for obj in session.dirty:
+        if isinstance(obj, (Permission, PermissionGroup)) and session.is_modified(obj):
+            break
+    else:
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, (Permission, PermissionGroup)):
+                break
+        else:
+            return
+    permission_group_catalog.bump(session)
+    session.info['pywebtools.permission_groups_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _expire_permission_group_catalog(session):
+    """Re-checks the :data:`~pywebtools.pyramid.auth.models.permission_group_catalog` on next
+    access if the committed session changed any
+    :class:`~pywebtools.pyramid.auth.models.PermissionGroup`. This also invalidates the
+    permission masks stored in the user cache (see :mod:`~pywebtools.pyramid.auth.cache`).
+    """
+    if session.info.pop('pywebtools.permission_groups_changed', False):
+        permission_group_catalog.expire()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _reset_permission_group_changes(session):
+    """Clears the changed flag if the session is rolled back."""
+    session.info.pop('pywebtools.permission_groups_changed', None)
+
+
 users_groups = Table('users_permission_groups', Base.metadata,
                      Column('user_id', ForeignKey(User.id,
                                                   name='users_permission_groups_users_fk'),
@@ -362,3 +829,104 @@ class TimeToken(Base):
 
 
 Index('time_tokens_full_ix', TimeToken.action, TimeToken.token, TimeToken.timeout)
+Index('time_tokens_timeout_ix', TimeToken.timeout)
+
+
+class OutboxMessage(Base):
+    """The :class:`~pywebtools.pyramid.auth.models.OutboxMessage` represents a callback
+    invocation that has been recorded by the :mod:`~pywebtools.pyramid.auth.outbox`, but not
+    yet been dispatched.
+
+    Instances of the :class:`~pywebtools.pyramid.auth.models.OutboxMessage` have the following attributes:
+
+    * ``id`` -- The unique database identifier
+    * ``callback`` -- The name of the callback to invoke
+    * ``args`` -- The encoded callback arguments and the application URL
+    * ``status`` -- "pending" or "failed"
+    * ``attempts`` -- The number of failed dispatch attempts
+    * ``available`` -- The timestamp from which the callback may be dispatched
+    * ``locked_until`` -- The timestamp until which a worker has claimed the callback
+    * ``error`` -- The error from the last failed dispatch attempt
+    """
+    __tablename__ = 'auth_outbox'
+
+    id = Column(Integer, primary_key=True)
+    callback = Column(Unicode(255))
+    args = Column(JSONUnicodeText)
+    status = Column(Unicode(255))
+    attempts = Column(Integer)
+    available = Column(DateTime())
+    locked_until = Column(DateTime())
+    error = Column(UnicodeText())
+
+
+Index('auth_outbox_pending_ix', OutboxMessage.status, OutboxMessage.available)
+
+
+def bulk_validate_users(dbsession, user_ids, user):
+    """Sets the status of all unconfirmed users in ``user_ids`` that the ``user`` is allowed
+    to edit to "active", using a single UPDATE statement. Must be called within a transaction.
+
+    :param dbsession: The database session to use
+    :param user_ids: The identifiers of the users to validate
+    :type user_ids: ``list`` of ``int``
+    :param user: The user performing the action
+    :type user: :class:`~pywebtools.pyramid.auth.models.User`
+    :return: The number of validated users
+    :rtype: ``int``
+    """
+    if not user_ids:
+        return 0
+    return dbsession.query(User).filter(and_(User.id.in_(user_ids),
+                                             User.status == 'unconfirmed',
+                                             User.allow_filter('edit', user))).\
+        update({User.status: 'active'}, synchronize_session=False)
+
+
+# The User relationships that bulk_delete_users removes itself
+_bulk_delete_relationships = set(['permissions', 'permission_groups', 'time_tokens'])
+
+
+def bulk_delete_users(dbsession, user_ids, user):
+    """Deletes all users in ``user_ids`` that the ``user`` is allowed to delete, together with
+    their permission links and time tokens, without loading them into the ``dbsession``. The
+    users are removed from the search and autocomplete indexes in the same transaction. Must
+    be called within a transaction.
+
+    If the application has added further relationships to the
+    :class:`~pywebtools.pyramid.auth.models.User`, then the ORM has to handle their cascades
+    and the users are instead loaded and deleted one by one via the ``dbsession``. Any
+    ``before_delete`` and ``after_delete`` listeners registered by the application on the
+    :class:`~pywebtools.pyramid.auth.models.User` are only called in that case.
+
+    :param dbsession: The database session to use
+    :param user_ids: The identifiers of the users to delete
+    :type user_ids: ``list`` of ``int``
+    :param user: The user performing the action
+    :type user: :class:`~pywebtools.pyramid.auth.models.User`
+    :return: The identifiers of the deleted users
+    :rtype: ``list`` of ``int``
+    """
+    from pywebtools.pyramid.auth import autocomplete, search
+
+    if not user_ids:
+        return []
+    query = dbsession.query(User).filter(and_(User.id.in_(user_ids),
+                                              User.allow_filter('delete', user)))
+    relationships = set(rel.key for rel in User.__mapper__.relationships if not rel.viewonly)
+    if relationships - _bulk_delete_relationships:
+        ids = []
+        for deleted in query:
+            ids.append(deleted.id)
+            dbsession.delete(deleted)
+        dbsession.flush()
+        return ids
+    ids = [row[0] for row in query.with_entities(User.id)]
+    if ids:
+        for table in [users_permissions, users_groups, TimeToken.__table__]:
+            dbsession.execute(table.delete().where(table.c.user_id.in_(ids)))
+        dbsession.execute(User.__table__.delete().where(User.__table__.c.id.in_(ids)))
+        search.remove_users(dbsession.connection(), ids)
+        autocomplete.record_removed(dbsession, ids)
+        mark_changed(dbsession)
+    return ids
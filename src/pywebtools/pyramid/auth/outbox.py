@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+##########################################################
+:mod:`pywebtools.pyramid.auth.outbox` -- Callback Outbox
+##########################################################
+
+The :mod:`~pywebtools.pyramid.auth.outbox` module moves the authentication callbacks (see
+:func:`~pywebtools.pyramid.auth.init`) out of the request. Instead of calling the callback
+directly, the views record an :class:`~pywebtools.pyramid.auth.models.OutboxMessage` in the
+same transaction that changes the :class:`~pywebtools.pyramid.auth.models.User`. If that
+transaction is rolled back, the message is rolled back with it, and a message is only ever
+dispatched after it has been committed. Each message is claimed by a single worker before
+it is dispatched and is deleted in the same transaction that runs the callback. Callbacks
+are delivered at least once: if a worker stops after running a callback, but before its
+transaction has been committed, or takes longer than its lease, then the callback is run
+again. Callbacks should thus be safe to repeat. Failed callbacks are retried with an
+exponential back-off.
+
+The callbacks are dispatched by the "pywebtools-dispatch-outbox" console script, which
+loads the application to get the callbacks::
+
+    pywebtools-dispatch-outbox production.ini
+
+Alternatively :func:`~pywebtools.pyramid.auth.outbox.start_workers` can be called from the
+application's WSGI app factory to start :class:`~pywebtools.pyramid.auth.outbox.OutboxWorker`
+threads in the application process. As the threads do not survive a fork, this must happen
+in each process that serves requests and not before a pre-forking server forks.
+
+The outbox is configured via the following settings in the [app:main] section of the
+INI file:
+
+* ``auth.outbox.enabled`` -- Set to "true" to record callbacks in the outbox.
+* ``auth.outbox.workers`` -- The number of worker threads started by
+  :func:`~pywebtools.pyramid.auth.outbox.start_workers` (default 1).
+* ``auth.outbox.poll_interval`` -- The number of seconds between checking for callbacks
+  that are ready to be retried (default 10).
+* ``auth.outbox.max_attempts`` -- The number of attempts after which a failing callback is
+  marked as "failed" (default 5).
+* ``auth.outbox.retry_delay`` -- The number of seconds before the first retry, doubled
+  for each further retry (default 60).
+
+As the callbacks no longer run within a request, they are called with a blank request that
+only provides the application's URL and registry. Any
+:class:`~pywebtools.pyramid.auth.models.User` and tokens passed to the callbacks are
+re-loaded when the callback is dispatched. If a user has been deleted or a token is no
+longer valid, then that entry is skipped in any list argument. If it is passed directly to
+the callback, then the callback is dropped.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import argparse
+import logging
+import threading
+import transaction
+
+from datetime import datetime, timedelta
+from pyramid.request import Request
+from pyramid.threadlocal import manager
+from sqlalchemy import and_, or_
+
+from pywebtools.pyramid.auth import tokens
+from pywebtools.pyramid.auth.models import OutboxMessage, User
+from pywebtools.pyramid.util import convert_type
+from pywebtools.sqlalchemy import DBSession
+
+
+logger = logging.getLogger(__name__)
+
+
+class StaleMessage(Exception):
+    """The :class:`~pywebtools.pyramid.auth.outbox.StaleMessage` is raised if the user or
+    token that a recorded callback refers to no longer exist.
+    """
+    pass
+
+
+def encode_args(args):
+    """Encode the callback ``args`` for storing in an
+    :class:`~pywebtools.pyramid.auth.models.OutboxMessage`.
+    :class:`~pywebtools.pyramid.auth.models.User` are stored by their id and tokens by their
+    action and value. Lists and tuples are encoded separately, as stale entries are skipped in
+    lists, while tuples are only decoded if all their entries are valid.
+
+    :param args: The callback arguments to encode
+    :type args: ``list``
+    :return: The encoded arguments
+    :rtype: ``list``
+    """
+    encoded = []
+    for value in args:
+        if isinstance(value, User):
+            encoded.append({'user': value.id})
+        elif isinstance(value, tuple):
+            encoded.append({'tuple': encode_args(value)})
+        elif isinstance(value, list):
+            encoded.append({'list': encode_args(value)})
+        elif hasattr(value, 'token') and hasattr(value, 'action'):
+            encoded.append({'token': [value.action, value.token]})
+        else:
+            encoded.append({'value': value})
+    return encoded
+
+
+def decode_args(dbsession, args):
+    """Decode the callback ``args`` encoded by :func:`~pywebtools.pyramid.auth.outbox.encode_args`,
+    loading the users and tokens via the ``dbsession``. Entries of a list that refer to a user
+    or token that no longer exists are skipped. Raises
+    :class:`~pywebtools.pyramid.auth.outbox.StaleMessage` if such a user or token is one of the
+    ``args`` or if all entries of a list are stale.
+
+    :param dbsession: The database session to load users and tokens with
+    :param args: The encoded callback arguments
+    :type args: ``list``
+    :return: The decoded arguments
+    :rtype: ``list``
+    """
+    decoded = []
+    for value in args:
+        if 'user' in value:
+            user = dbsession.query(User).get(value['user'])
+            if user is None:
+                raise StaleMessage('User %s no longer exists' % value['user'])
+            decoded.append(user)
+        elif 'list' in value:
+            entries = []
+            for entry in value['list']:
+                try:
+                    entries.extend(decode_args(dbsession, [entry]))
+                except StaleMessage:
+                    pass
+            if value['list'] and not entries:
+                raise StaleMessage('All list entries are stale')
+            decoded.append(entries)
+        elif 'tuple' in value:
+            decoded.append(tuple(decode_args(dbsession, value['tuple'])))
+        elif 'token' in value:
+            token = tokens.active_backend.find(dbsession, value['token'][0], value['token'][1])
+            if token is None:
+                raise StaleMessage('Token is no longer valid')
+            decoded.append(token)
+        else:
+            decoded.append(value['value'])
+    return decoded
+
+
+class CallbackOutbox(object):
+    """The :class:`~pywebtools.pyramid.auth.outbox.CallbackOutbox` records callback invocations
+    as :class:`~pywebtools.pyramid.auth.models.OutboxMessage` and dispatches them.
+    """
+
+    def __init__(self, registry, callbacks, max_attempts=5, retry_delay=60, lease=300):
+        """
+        :param registry: The application registry, used for the requests passed to the callbacks
+        :type registry: :class:`~pyramid.registry.Registry`
+        :param callbacks: The callbacks by name
+        :type callbacks: ``dict``
+        :param max_attempts: The number of attempts after which a failing callback is marked as "failed"
+        :type max_attempts: ``int``
+        :param retry_delay: The number of seconds before the first retry
+        :type retry_delay: ``int``
+        :param lease: The number of seconds a worker may take to dispatch a claimed callback,
+                      before another worker may claim it
+        :type lease: ``int``
+        """
+        self.registry = registry
+        self.callbacks = callbacks
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.committed = threading.Event()
+
+    def enqueue(self, dbsession, request, name, *args):
+        """Record the invocation of the callback ``name`` with the ``args``. Must be called within
+        the transaction that the callback depends on.
+
+        :param dbsession: The database session to record the callback in
+        :param request: The current request
+        :type request: :class:`~pyramid.request.Request`
+        :param name: The name of the callback
+        :type name: `unicode`
+        """
+        dbsession.add(OutboxMessage(callback=name,
+                                    args={'url': request.application_url,
+                                          'args': encode_args(args)},
+                                    status='pending',
+                                    attempts=0,
+                                    available=datetime.now()))
+        transaction.get().addAfterCommitHook(self._after_commit)
+
+    def _after_commit(self, success):
+        """Wake the workers once a transaction with a new message has been committed."""
+        if success:
+            self.committed.set()
+
+    def dispatch(self, batch_size=100):
+        """Dispatch up to ``batch_size`` callbacks that are ready to be dispatched.
+
+        :param batch_size: The maximum number of callbacks to dispatch
+        :type batch_size: ``int``
+        :return: The number of dispatched callbacks, including failed attempts
+        :rtype: ``int``
+        """
+        dbsession = DBSession()
+        now = datetime.now()
+        with transaction.manager:
+            ids = [row[0] for row in dbsession.query(OutboxMessage.id).
+                   filter(and_(OutboxMessage.status == 'pending',
+                               OutboxMessage.available <= now,
+                               or_(OutboxMessage.locked_until == None,  # noqa: E711
+                                   OutboxMessage.locked_until < now))).
+                   order_by(OutboxMessage.id).limit(batch_size)]
+        count = 0
+        for mid in ids:
+            if self._claim(dbsession, mid):
+                self._deliver(dbsession, mid)
+                count = count + 1
+        return count
+
+    def _claim(self, dbsession, mid):
+        """Claim the message ``mid`` for this worker. Returns ``True`` if it was claimed."""
+        now = datetime.now()
+        with transaction.manager:
+            claimed = dbsession.query(OutboxMessage).\
+                filter(and_(OutboxMessage.id == mid,
+                            OutboxMessage.status == 'pending',
+                            or_(OutboxMessage.locked_until == None,  # noqa: E711
+                                OutboxMessage.locked_until < now))).\
+                update({OutboxMessage.locked_until: now + timedelta(seconds=self.lease)},
+                       synchronize_session=False)
+        return claimed == 1
+
+    def _deliver(self, dbsession, mid):
+        """Run the callback for the claimed message ``mid`` and delete the message in the same
+        transaction. If the callback fails, schedules a retry.
+        """
+        try:
+            with transaction.manager:
+                message = dbsession.query(OutboxMessage).get(mid)
+                if message.callback in self.callbacks:
+                    args = decode_args(dbsession, message.args['args'])
+                    request = Request.blank('/', base_url=message.args['url'])
+                    request.registry = self.registry
+                    manager.push({'registry': self.registry, 'request': request})
+                    try:
+                        self.callbacks[message.callback](request, *args)
+                    finally:
+                        manager.pop()
+                else:
+                    logger.warning('No callback registered for %s', message.callback)
+                dbsession.delete(message)
+        except StaleMessage as e:
+            logger.info('Dropping callback %i: %s', mid, e)
+            with transaction.manager:
+                dbsession.query(OutboxMessage).filter(OutboxMessage.id == mid).delete(synchronize_session=False)
+        except Exception as e:
+            logger.exception('Callback %i failed', mid)
+            with transaction.manager:
+                message = dbsession.query(OutboxMessage).get(mid)
+                message.attempts = message.attempts + 1
+                message.error = str(e)
+                message.locked_until = None
+                if message.attempts >= self.max_attempts:
+                    message.status = 'failed'
+                else:
+                    message.available = datetime.now() + \
+                        timedelta(seconds=self.retry_delay * 2 ** (message.attempts - 1))
+
+
+class OutboxWorker(threading.Thread):
+    """The :class:`~pywebtools.pyramid.auth.outbox.OutboxWorker` is a daemon thread that
+    dispatches the callbacks recorded in a :class:`~pywebtools.pyramid.auth.outbox.CallbackOutbox`,
+    whenever a new callback has been committed or at least every ``poll_interval`` seconds.
+    """
+
+    def __init__(self, outbox, poll_interval=10):
+        """
+        :param outbox: The outbox to dispatch the callbacks from
+        :type outbox: :class:`~pywebtools.pyramid.auth.outbox.CallbackOutbox`
+        :param poll_interval: The maximum number of seconds between dispatch runs
+        :type poll_interval: ``int``
+        """
+        threading.Thread.__init__(self, name='pywebtools-outbox-worker', daemon=True)
+        self.outbox = outbox
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.outbox.committed.wait(self.poll_interval)
+            self.outbox.committed.clear()
+            try:
+                while not self._stopped.is_set() and self.outbox.dispatch():
+                    pass
+            except Exception:
+                logger.exception('Failed to dispatch callbacks')
+            finally:
+                DBSession.remove()
+
+    def stop(self):
+        """Stop the :class:`~pywebtools.pyramid.auth.outbox.OutboxWorker` after the current run."""
+        self._stopped.set()
+        self.outbox.committed.set()
+
+
+# The process-wide outbox. None if the outbox is not enabled.
+active_outbox = None
+
+
+def enqueue_callback(dbsession, request, name, *args):
+    """Record the invocation of the callback ``name`` in the process-wide outbox, if the outbox
+    is enabled and a callback with that ``name`` has been registered. Must be called within the
+    transaction that the callback depends on.
+
+    :param dbsession: The database session to record the callback in
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param name: The name of the callback
+    :type name: `unicode`
+    :return: ``True`` if the callback has been recorded, ``False`` if it must be called directly
+    :rtype: ``bool``
+    """
+    if active_outbox is None:
+        return False
+    if name in active_outbox.callbacks:
+        active_outbox.enqueue(dbsession, request, name, *args)
+    return True
+
+
+def start_workers(settings):
+    """Start the number of :class:`~pywebtools.pyramid.auth.outbox.OutboxWorker` threads set
+    via ``auth.outbox.workers`` in the current process. Must be called after
+    :func:`~pywebtools.pyramid.auth.init` in each process that should dispatch callbacks.
+
+    :param settings: The application settings
+    :type settings: ``dict``
+    :return: The started workers
+    :rtype: ``list`` of :class:`~pywebtools.pyramid.auth.outbox.OutboxWorker`
+    """
+    workers = []
+    if active_outbox is not None:
+        poll_interval = convert_type(settings.get('auth.outbox.poll_interval', ''), 'int', default=10)
+        for _ in range(convert_type(settings.get('auth.outbox.workers', ''), 'int', default=1)):
+            worker = OutboxWorker(active_outbox, poll_interval=poll_interval)
+            worker.start()
+            workers.append(worker)
+    return workers
+
+
+def dispatch_main(argv=None):
+    """Console script that loads the application from the given configuration file and
+    dispatches the callbacks recorded in its outbox.
+    """
+    from pyramid.paster import bootstrap, setup_logging
+
+    parser = argparse.ArgumentParser(description='Dispatch the authentication callbacks')
+    parser.add_argument('config_uri', help='The application configuration file')
+    parser.add_argument('--poll-interval', type=int, default=10,
+                        help='The number of seconds between checking for new callbacks')
+    parser.add_argument('--once', action='store_true', default=False,
+                        help='Dispatch all callbacks that are ready and then exit')
+    args = parser.parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    try:
+        if active_outbox is None:
+            parser.error('The outbox is not enabled in %s' % args.config_uri)
+        if args.once:
+            count = 0
+            while True:
+                dispatched = active_outbox.dispatch()
+                if not dispatched:
+                    break
+                count = count + dispatched
+            print('Dispatched %i callbacks' % count)
+        else:
+            worker = OutboxWorker(active_outbox, poll_interval=args.poll_interval)
+            worker.run()
+    finally:
+        env['closer']()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+################################################################
+:mod:`pywebtools.pyramid.auth.passwords` -- Password Hashing
+################################################################
+
+The :mod:`~pywebtools.pyramid.auth.passwords` module provides the password hashing used by
+the :class:`~pywebtools.pyramid.auth.models.User`. Passwords are hashed with a slow,
+cost-tunable key derivation function and the parameters are stored together with the hash,
+so that the cost can be increased without invalidating existing passwords. Hashes created
+with older parameters (including the original salted SHA-512 hashes) are still verified and
+:func:`~pywebtools.pyramid.auth.passwords.needs_rehash` reports when they should be
+re-hashed.
+
+Two hashers are available:
+
+* :class:`~pywebtools.pyramid.auth.passwords.PBKDF2Hasher` -- PBKDF2-HMAC-SHA512, where the
+  cost is the number of iterations (default).
+* :class:`~pywebtools.pyramid.auth.passwords.ScryptHasher` -- scrypt, where the cost is the
+  base-2 logarithm of the CPU/memory cost ``n``. Only available if the Python ``hashlib``
+  provides ``scrypt``.
+
+All hashing runs in a bounded thread pool if one has been set up via
+:func:`~pywebtools.pyramid.auth.passwords.configure`, which limits the CPU time spent on
+password hashing during peak login traffic.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pyramid.exceptions import ConfigurationError
+
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHasherBusy(Exception):
+    """The :class:`~pywebtools.pyramid.auth.passwords.PasswordHasherBusy` is raised if a
+    password cannot be checked, because too many password checks are already waiting for
+    the hashing thread pool.
+    """
+    pass
+
+
+class PBKDF2Hasher(object):
+    """The :class:`~pywebtools.pyramid.auth.passwords.PBKDF2Hasher` hashes passwords using
+    PBKDF2-HMAC-SHA512. Hashes are encoded as "pbkdf2_sha512$iterations$hash".
+    """
+
+    algorithm = 'pbkdf2_sha512'
+
+    def __init__(self, cost=100000):
+        """
+        :param cost: The number of iterations
+        :type cost: ``int``
+        """
+        self.cost = cost
+
+    @property
+    def parameters(self):
+        """The encoded hash parameters."""
+        return '%s$%i' % (self.algorithm, self.cost)
+
+    def encode(self, password, salt):
+        """Hash the ``password`` with the ``salt``.
+
+        :param password: The cleartext password
+        :type password: `unicode`
+        :param salt: The salt
+        :type salt: `unicode`
+        :return: The encoded hash
+        :rtype: `unicode`
+        """
+        digest = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt.encode('utf-8'), self.cost)
+        return '%s$%s' % (self.parameters, digest.hex())
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        """Create a new hasher with the parameters from the ``encoded`` hash.
+
+        :param encoded: The encoded hash
+        :type encoded: `unicode`
+        :return: The hasher
+        :rtype: :class:`~pywebtools.pyramid.auth.passwords.PBKDF2Hasher`
+        """
+        return cls(int(encoded.split('$')[1]))
+
+    @classmethod
+    def calibrate(cls, target_ms):
+        """Create a new hasher with the number of iterations chosen so that hashing takes
+        about ``target_ms`` milliseconds on the current machine.
+
+        :param target_ms: The target time in milliseconds
+        :type target_ms: ``int``
+        :return: The calibrated hasher
+        :rtype: :class:`~pywebtools.pyramid.auth.passwords.PBKDF2Hasher`
+        """
+        hasher = cls(10000)
+        elapsed = _time_hasher(hasher)
+        return cls(max(10000, int(hasher.cost * target_ms / (elapsed * 1000))))
+
+
+class ScryptHasher(object):
+    """The :class:`~pywebtools.pyramid.auth.passwords.ScryptHasher` hashes passwords using
+    scrypt. Hashes are encoded as "scrypt$log2(n)$r$p$hash".
+    """
+
+    algorithm = 'scrypt'
+
+    def __init__(self, cost=14, block_size=8, parallelism=1):
+        """
+        :param cost: The base-2 logarithm of the CPU/memory cost
+        :type cost: ``int``
+        :param block_size: The block size
+        :type block_size: ``int``
+        :param parallelism: The parallelisation factor
+        :type parallelism: ``int``
+        """
+        self.cost = cost
+        self.block_size = block_size
+        self.parallelism = parallelism
+
+    @property
+    def parameters(self):
+        """The encoded hash parameters."""
+        return '%s$%i$%i$%i' % (self.algorithm, self.cost, self.block_size, self.parallelism)
+
+    def encode(self, password, salt):
+        """Hash the ``password`` with the ``salt``.
+
+        :param password: The cleartext password
+        :type password: `unicode`
+        :param salt: The salt
+        :type salt: `unicode`
+        :return: The encoded hash
+        :rtype: `unicode`
+        """
+        n = 2 ** self.cost
+        digest = hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=self.block_size,
+                                p=self.parallelism, maxmem=256 * n * self.block_size, dklen=64)
+        return '%s$%s' % (self.parameters, digest.hex())
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        """Create a new hasher with the parameters from the ``encoded`` hash.
+
+        :param encoded: The encoded hash
+        :type encoded: `unicode`
+        :return: The hasher
+        :rtype: :class:`~pywebtools.pyramid.auth.passwords.ScryptHasher`
+        """
+        parts = encoded.split('$')
+        return cls(int(parts[1]), int(parts[2]), int(parts[3]))
+
+    @classmethod
+    def calibrate(cls, target_ms):
+        """Create a new hasher with the cost chosen so that hashing takes at least
+        ``target_ms`` milliseconds on the current machine.
+
+        :param target_ms: The target time in milliseconds
+        :type target_ms: ``int``
+        :return: The calibrated hasher
+        :rtype: :class:`~pywebtools.pyramid.auth.passwords.ScryptHasher`
+        """
+        hasher = cls(12)
+        while hasher.cost < 20 and _time_hasher(hasher) * 1000 < target_ms:
+            hasher = cls(hasher.cost + 1)
+        return hasher
+
+
+class LegacyHasher(object):
+    """The :class:`~pywebtools.pyramid.auth.passwords.LegacyHasher` verifies the salted SHA-512
+    hashes created by earlier versions. It is never used to create new hashes.
+    """
+
+    algorithm = None
+    parameters = None
+
+    def encode(self, password, salt):
+        """Hash the ``password`` with the ``salt``.
+
+        :param password: The cleartext password
+        :type password: `unicode`
+        :param salt: The salt
+        :type salt: `unicode`
+        :return: The encoded hash
+        :rtype: `unicode`
+        """
+        return str(hashlib.sha512(('%s$$%s' % (salt, password)).encode('utf-8')).hexdigest())
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        """Create a new :class:`~pywebtools.pyramid.auth.passwords.LegacyHasher`."""
+        return cls()
+
+
+hashers = {PBKDF2Hasher.algorithm: PBKDF2Hasher}
+"""The available hashers, by their algorithm name."""
+if hasattr(hashlib, 'scrypt'):
+    hashers[ScryptHasher.algorithm] = ScryptHasher
+
+# The hasher used for new passwords
+active_hasher = PBKDF2Hasher()
+# The thread pool to run the hashing in and the number of password checks that may wait for it
+_executor = None
+_slots = None
+
+
+def _time_hasher(hasher):
+    """Returns the number of seconds the ``hasher`` takes to hash a password."""
+    start = time.perf_counter()
+    hasher.encode('calibration password', 'calibration salt')
+    return max(time.perf_counter() - start, 0.0001)
+
+
+def _hasher_for(encoded):
+    """Returns the hasher that can verify the ``encoded`` hash."""
+    if encoded and '$' in encoded:
+        algorithm = encoded.split('$', 1)[0]
+        if algorithm in hashers:
+            return hashers[algorithm].from_encoded(encoded)
+        raise ValueError('Unsupported password hash algorithm %s' % algorithm)
+    return LegacyHasher()
+
+
+def _run(func, args, reject=False):
+    """Runs ``func`` in the hashing thread pool, if one is configured. If ``reject`` is
+    ``True`` and the maximum number of waiting tasks has been reached, then raises
+    :class:`~pywebtools.pyramid.auth.passwords.PasswordHasherBusy`.
+    """
+    if _executor is None:
+        return func(*args)
+    if reject and _slots is not None:
+        if not _slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            return _executor.submit(func, *args).result()
+        finally:
+            _slots.release()
+    return _executor.submit(func, *args).result()
+
+
+def configure(hasher=None, cost=None, target_ms=None, workers=0, max_pending=0):
+    """Configure the password hashing.
+
+    :param hasher: The name of the hasher to use for new passwords (default "pbkdf2_sha512").
+                   Raises :class:`~pyramid.exceptions.ConfigurationError` if the hasher is
+                   unknown or not available
+    :type hasher: ``str``
+    :param cost: The hasher's cost. If not set, the hasher's default cost is used, unless
+                 ``target_ms`` is set
+    :type cost: ``int``
+    :param target_ms: If set and no ``cost`` is given, calibrates the hasher's cost so that
+                      hashing takes about that many milliseconds
+    :type target_ms: ``int``
+    :param workers: The number of threads to run the hashing in. If 0, hashing runs in the
+                    calling thread
+    :type workers: ``int``
+    :param max_pending: The maximum number of password checks that may be queued for or
+                        running in the thread pool. If exceeded, further checks raise
+                        :class:`~pywebtools.pyramid.auth.passwords.PasswordHasherBusy`.
+                        If 0, there is no limit
+    :type max_pending: ``int``
+    """
+    global active_hasher, _executor, _slots
+    if (hasher or PBKDF2Hasher.algorithm) not in hashers:
+        raise ConfigurationError('Unknown or unavailable password hasher %s' % hasher)
+    hasher_class = hashers[hasher or PBKDF2Hasher.algorithm]
+    if cost:
+        active_hasher = hasher_class(cost)
+    elif target_ms:
+        active_hasher = hasher_class.calibrate(target_ms)
+    else:
+        active_hasher = hasher_class()
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    if workers:
+        _executor = ThreadPoolExecutor(max_workers=workers)
+        _slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+    else:
+        _executor = None
+        _slots = None
+
+
+def hash_password(password, salt):
+    """Hash the ``password`` with the ``salt`` using the active hasher.
+
+    :param password: The cleartext password
+    :type password: `unicode`
+    :param salt: The salt
+    :type salt: `unicode`
+    :return: The encoded hash
+    :rtype: `unicode`
+    """
+    return _run(active_hasher.encode, (password, salt))
+
+
+def verify_password(password, salt, encoded):
+    """Check whether the ``password`` matches the ``encoded`` hash. Raises
+    :class:`~pywebtools.pyramid.auth.passwords.PasswordHasherBusy` if too many checks are
+    waiting for the hashing thread pool. If the ``encoded`` hash uses an algorithm that is
+    not available or cannot be parsed, then the password does not match.
+
+    If there is no ``encoded`` hash, then the ``password`` is hashed with the active hasher
+    anyway, so that checking the password of a user that does not exist or has no password
+    takes as long as checking a wrong password.
+
+    :param password: The cleartext password
+    :type password: `unicode`
+    :param salt: The salt
+    :type salt: `unicode`
+    :param encoded: The encoded hash to check against
+    :type encoded: `unicode`
+    :return: ``True`` if the password matches, ``False`` otherwise
+    :rtype: ``bool``
+    """
+    if not encoded or salt is None:
+        _run(active_hasher.encode, (password, 'no salt'), reject=True)
+        return False
+    try:
+        hasher = _hasher_for(encoded)
+    except (IndexError, ValueError) as e:
+        logger.warning('Cannot verify password hash: %s', e)
+        return False
+    hashed = _run(hasher.encode, (password, salt), reject=True)
+    return hmac.compare_digest(hashed.encode('utf-8'), encoded.encode('utf-8'))
+
+
+def needs_rehash(encoded):
+    """Check whether the ``encoded`` hash was created with different parameters than the
+    active hasher uses.
+
+    :param encoded: The encoded hash
+    :type encoded: `unicode`
+    :return: ``True`` if the password should be re-hashed
+    :rtype: ``bool``
+    """
+    return not encoded or encoded.rsplit('$', 1)[0] != active_hasher.parameters
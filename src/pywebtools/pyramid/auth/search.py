@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+###########################################################
+:mod:`pywebtools.pyramid.auth.search` -- User Search Index
+###########################################################
+
+The :mod:`~pywebtools.pyramid.auth.search` module provides the search index used to find
+:class:`~pywebtools.pyramid.auth.models.User` by a part of their display name or e-mail
+address. Two indexes are available:
+
+* :class:`~pywebtools.pyramid.auth.search.TrigramSearchIndex` -- Uses a SQLite FTS5 table
+  with the trigram tokenizer, so that searches only touch the matching users. The table
+  is kept in sync with the "users" table via ORM events, within the same transaction.
+* :class:`~pywebtools.pyramid.auth.search.LikeSearchIndex` -- Generic fallback that filters
+  the "users" table with ``LIKE``.
+
+The index is configured via the ``auth.users.search`` setting (see
+:func:`~pywebtools.pyramid.auth.init`), which can be "auto" (default, uses the trigram index
+if the database is SQLite and supports it), "trigram", or "like". The trigram table is
+created and filled by :func:`~pywebtools.pyramid.auth.init` if the ``DBSession`` is already
+bound to an engine. Otherwise :func:`~pywebtools.pyramid.auth.search.create_index` must be
+called at startup or from a database migration. Until the table exists, searches use
+``LIKE``.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+from sqlalchemy import bindparam, event, inspect, or_, text
+
+from pywebtools.pyramid.auth.models import User
+from pywebtools.sqlalchemy import DBSession
+
+
+class LikeSearchIndex(object):
+    """The :class:`~pywebtools.pyramid.auth.search.LikeSearchIndex` searches the "users" table
+    directly, using ``LIKE``. It needs no additional storage, but every search scans the whole
+    table.
+    """
+
+    def matches(self, q):
+        """Returns a filter expression that restricts a query to the users whose display name or
+        e-mail address contains ``q``.
+
+        :param q: The text to search for
+        :type q: `unicode`
+        :return: The filter expression
+        """
+        return or_(User.display_name.contains(q), User.email.contains(q))
+
+    def update(self, connection, user):
+        """Update the index entry for the ``user``."""
+        pass
+
+    def delete(self, connection, user_ids):
+        """Remove the index entries for the ``user_ids``."""
+        pass
+
+
+class TrigramSearchIndex(LikeSearchIndex):
+    """The :class:`~pywebtools.pyramid.auth.search.TrigramSearchIndex` stores each user's display
+    name and e-mail address in the SQLite FTS5 table ``table``, using the trigram tokenizer and
+    the user's id as the rowid. Search texts shorter than three characters cannot be matched
+    via trigrams and fall back to ``LIKE``.
+    """
+
+    def __init__(self, table='users_search'):
+        """
+        :param table: The name of the FTS5 table
+        :type table: ``str``
+        """
+        self.table = table
+
+    def exists(self, connection):
+        """Check whether the FTS5 table exists.
+
+        :param connection: The database connection to use
+        :return: ``True`` if the table exists
+        :rtype: ``bool``
+        """
+        return connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                  name=self.table).first() is not None
+
+    def create(self, connection):
+        """Create the FTS5 table, if it does not exist, and fill it with all users.
+
+        :param connection: The database connection to use
+        """
+        if not self.exists(connection):
+            connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS %s "
+                                    "USING fts5(display_name, email, tokenize='trigram')" % self.table))
+            connection.execute(text('INSERT OR REPLACE INTO %s (rowid, display_name, email) '
+                                    'SELECT id, display_name, email FROM users' % self.table))
+
+    def matches(self, q):
+        """Returns a filter expression that restricts a query to the users whose display name or
+        e-mail address contains ``q``.
+
+        :param q: The text to search for
+        :type q: `unicode`
+        :return: The filter expression
+        """
+        if len(q) < 3:
+            return LikeSearchIndex.matches(self, q)
+        return User.id.in_(text('SELECT rowid FROM %s WHERE %s MATCH :search_q' % (self.table, self.table)).
+                           bindparams(search_q='"%s"' % q.replace('"', '""')))
+
+    def update(self, connection, user):
+        """Update the index entry for the ``user``.
+
+        :param connection: The database connection to use
+        :param user: The user to update the entry for
+        :type user: :class:`~pywebtools.pyramid.auth.models.User`
+        """
+        connection.execute(text('INSERT OR REPLACE INTO %s (rowid, display_name, email) '
+                                'VALUES (:id, :display_name, :email)' % self.table),
+                           id=user.id, display_name=user.display_name, email=user.email)
+
+    def delete(self, connection, user_ids):
+        """Remove the index entries for the ``user_ids``.
+
+        :param connection: The database connection to use
+        :param user_ids: The identifiers of the users to remove
+        :type user_ids: ``list`` of ``int``
+        """
+        if user_ids:
+            connection.execute(text('DELETE FROM %s WHERE rowid IN :ids' % self.table).
+                               bindparams(bindparam('ids', expanding=True)),
+                               ids=list(user_ids))
+
+
+def supports_trigram(connection):
+    """Check whether the database behind the ``connection`` supports FTS5 trigram tables.
+
+    :param connection: The database connection to check
+    :return: ``True`` if trigram tables are supported
+    :rtype: ``bool``
+    """
+    if connection.dialect.name != 'sqlite':
+        return False
+    version = connection.execute(text('SELECT sqlite_version()')).scalar()
+    if tuple(int(part) for part in version.split('.')) < (3, 34, 0):
+        return False
+    return bool(connection.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+
+
+# The configured search mode, whether the database supports trigram tables, and the
+# process-wide search index
+search_mode = 'auto'
+trigram_supported = None
+active_index = None
+
+
+def configure(mode='auto', bind=None):
+    """Configure the search index. If a ``bind`` is given, the "users" table exists, and the
+    ``mode`` uses the :class:`~pywebtools.pyramid.auth.search.TrigramSearchIndex`, then its
+    table is created and filled if it does not exist.
+
+    :param mode: "auto", "trigram", or "like"
+    :type mode: ``str``
+    :param bind: The engine to create the table with
+    :type bind: :class:`~sqlalchemy.engine.Engine`
+    """
+    global search_mode, trigram_supported, active_index
+    search_mode = mode
+    trigram_supported = None
+    active_index = None
+    if bind is not None:
+        with bind.begin() as connection:
+            if connection.dialect.has_table(connection, 'users'):
+                create_index(connection)
+
+
+def _uses_trigram(connection):
+    """Check whether the ``search_mode`` uses the trigram table on the ``connection``'s database."""
+    global trigram_supported
+    if search_mode == 'like':
+        return False
+    elif search_mode == 'trigram':
+        return True
+    if trigram_supported is None:
+        trigram_supported = supports_trigram(connection)
+    return trigram_supported
+
+
+def create_index(connection):
+    """Create and fill the trigram table, if the ``search_mode`` uses it and it does not exist.
+    Can be called from a database migration.
+
+    :param connection: The database connection to use
+    """
+    global active_index
+    if _uses_trigram(connection):
+        index = TrigramSearchIndex()
+        index.create(connection)
+        active_index = index
+
+
+def _resolve_index(connection):
+    """Returns the search index to use for the ``search_mode`` or ``None`` if the trigram table
+    should be used, but does not exist. Only an existing index is stored as the process-wide
+    index, so that a table created later, for example by another process, is picked up.
+    """
+    global active_index
+    if active_index is None:
+        if _uses_trigram(connection):
+            index = TrigramSearchIndex()
+            if not index.exists(connection):
+                return None
+            active_index = index
+        else:
+            active_index = LikeSearchIndex()
+    return active_index
+
+
+def get_search_index():
+    """Get the process-wide search index. If the trigram table has not been created yet (see
+    :func:`~pywebtools.pyramid.auth.search.create_index`), then a
+    :class:`~pywebtools.pyramid.auth.search.LikeSearchIndex` is returned.
+
+    :return: The search index
+    :rtype: :class:`~pywebtools.pyramid.auth.search.LikeSearchIndex`
+    """
+    if active_index is not None:
+        return active_index
+    with DBSession().get_bind().connect() as connection:
+        index = _resolve_index(connection)
+    return index if index is not None else LikeSearchIndex()
+
+
+def _flush_index(connection):
+    """Returns the search index to update during a flush or ``None`` if the trigram table does
+    not exist yet.
+    """
+    return _resolve_index(connection)
+
+
+def remove_users(connection, user_ids):
+    """Remove the users with the ``user_ids`` from the search index. Used for users that have
+    been deleted without loading them into a session.
+
+    :param connection: The database connection to use
+    :param user_ids: The identifiers of the users to remove
+    :type user_ids: ``list`` of ``int``
+    """
+    index = _flush_index(connection)
+    if index is not None:
+        index.delete(connection, user_ids)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_added(mapper, connection, target):
+    """Adds a new :class:`~pywebtools.pyramid.auth.models.User` to the search index."""
+    index = _flush_index(connection)
+    if index is not None:
+        index.update(connection, target)
+
+
+@event.listens_for(User, 'after_update')
+def _user_changed(mapper, connection, target):
+    """Keeps the search index in sync when the display name or e-mail address of a
+    :class:`~pywebtools.pyramid.auth.models.User` has changed.
+    """
+    attrs = inspect(target).attrs
+    if attrs.display_name.history.has_changes() or attrs.email.history.has_changes():
+        index = _flush_index(connection)
+        if index is not None:
+            index.update(connection, target)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    """Removes a deleted :class:`~pywebtools.pyramid.auth.models.User` from the search index."""
+    index = _flush_index(connection)
+    if index is not None:
+        index.delete(connection, [target.id])
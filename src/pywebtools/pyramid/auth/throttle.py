@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+###########################################################
+:mod:`pywebtools.pyramid.auth.throttle` -- Login Throttling
+###########################################################
+
+The :mod:`~pywebtools.pyramid.auth.throttle` module provides a sliding-window throttle
+for failed logins, keyed both by e-mail address and by client address. Failed logins are
+recorded outside of the application database, so that brute-force attacks cause neither
+database writes nor password hashing work once the limit has been reached.
+
+The throttle is configured via the following settings in the [app:main] section of the
+INI file:
+
+* ``auth.throttle.limit`` -- The number of failed logins per e-mail address that are allowed
+  within the window. If not set or 0, then throttling is disabled.
+* ``auth.throttle.address_limit`` -- The number of failed logins per client address that are
+  allowed within the window (default five times the ``auth.throttle.limit``).
+* ``auth.throttle.window`` -- The length of the sliding window in seconds (default 300).
+* ``auth.throttle.sqlite`` -- If set, the path of a SQLite file used to share the failed
+  logins between multiple worker processes. Otherwise failed logins are tracked in memory
+  per process.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from pywebtools.pyramid.util import get_config_setting
+
+
+class MemoryThrottleStore(object):
+    """The :class:`~pywebtools.pyramid.auth.throttle.MemoryThrottleStore` tracks failed logins
+    in memory, for a single process. The keys are kept in the order of their last failed
+    login, so that expired keys and, if there are more than ``max_keys`` keys, the least
+    recently hit keys can be removed without scanning all keys.
+    """
+
+    def __init__(self, max_keys=100000):
+        """
+        :param max_keys: The maximum number of keys to track
+        :type max_keys: ``int``
+        """
+        self.max_keys = max_keys
+        self._hits = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, now, window):
+        """Record a failed login for the ``key``.
+
+        :param key: The key to record the failed login for
+        :type key: ``str``
+        :param now: The current timestamp
+        :type now: ``float``
+        :param window: The length of the sliding window in seconds
+        :type window: ``int``
+        """
+        with self._lock:
+            if key in self._hits:
+                self._hits.move_to_end(key)
+            else:
+                self._expire(now - window)
+                while len(self._hits) >= self.max_keys:
+                    self._hits.popitem(last=False)
+                self._hits[key] = deque()
+            self._hits[key].append(now)
+
+    def count(self, key, since):
+        """Count the failed logins for the ``key`` since the timestamp ``since``.
+
+        :param key: The key to count the failed logins for
+        :type key: ``str``
+        :param since: The start of the sliding window
+        :type since: ``float``
+        :return: The number of failed logins
+        :rtype: ``int``
+        """
+        with self._lock:
+            if key in self._hits:
+                hits = self._hits[key]
+                while hits and hits[0] < since:
+                    hits.popleft()
+                if hits:
+                    return len(hits)
+                del self._hits[key]
+        return 0
+
+    def clear(self, key):
+        """Remove all failed logins for the ``key``.
+
+        :param key: The key to remove the failed logins for
+        :type key: ``str``
+        """
+        with self._lock:
+            self._hits.pop(key, None)
+
+    def _expire(self, since):
+        """Remove the keys that have no failed logins since the timestamp ``since``. As the keys
+        are ordered by their last failed login, only the expired keys are visited.
+        """
+        while self._hits:
+            key, hits = next(iter(self._hits.items()))
+            if hits and hits[-1] >= since:
+                break
+            del self._hits[key]
+
+
+class SQLiteThrottleStore(object):
+    """The :class:`~pywebtools.pyramid.auth.throttle.SQLiteThrottleStore` tracks failed logins
+    in a SQLite file, so that they can be shared between multiple worker processes on the
+    same machine.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the SQLite file
+        :type path: ``str``
+        """
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS login_failures (key TEXT NOT NULL, timestamp REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS login_failures_ix ON login_failures (key, timestamp)')
+        connection.execute('CREATE INDEX IF NOT EXISTS login_failures_timestamp_ix ON login_failures (timestamp)')
+        connection.commit()
+
+    def _connection(self):
+        """Returns the SQLite connection for the current thread."""
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.path, timeout=5)
+        return self._local.connection
+
+    def hit(self, key, now, window):
+        """Record a failed login for the ``key`` and remove all failed logins that are older
+        than the ``window``.
+
+        :param key: The key to record the failed login for
+        :type key: ``str``
+        :param now: The current timestamp
+        :type now: ``float``
+        :param window: The length of the sliding window in seconds
+        :type window: ``int``
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM login_failures WHERE timestamp < ?', (now - window, ))
+            connection.execute('INSERT INTO login_failures (key, timestamp) VALUES (?, ?)', (key, now))
+
+    def count(self, key, since):
+        """Count the failed logins for the ``key`` since the timestamp ``since``.
+
+        :param key: The key to count the failed logins for
+        :type key: ``str``
+        :param since: The start of the sliding window
+        :type since: ``float``
+        :return: The number of failed logins
+        :rtype: ``int``
+        """
+        return self._connection().execute('SELECT COUNT(*) FROM login_failures WHERE key = ? AND timestamp >= ?',
+                                          (key, since)).fetchone()[0]
+
+    def clear(self, key):
+        """Remove all failed logins for the ``key``.
+
+        :param key: The key to remove the failed logins for
+        :type key: ``str``
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM login_failures WHERE key = ?', (key, ))
+
+
+class LoginThrottle(object):
+    """The :class:`~pywebtools.pyramid.auth.throttle.LoginThrottle` limits the number of failed
+    logins per e-mail address and per client address within a sliding window.
+    """
+
+    def __init__(self, store, limit, address_limit, window):
+        """
+        :param store: The store to track failed logins in
+        :param limit: The number of failed logins allowed per e-mail address
+        :type limit: ``int``
+        :param address_limit: The number of failed logins allowed per client address
+        :type address_limit: ``int``
+        :param window: The length of the sliding window in seconds
+        :type window: ``int``
+        """
+        self.store = store
+        self.limit = limit
+        self.address_limit = address_limit
+        self.window = window
+
+    def _email_key(self, email):
+        """Returns the store key for the ``email``, normalised in the same way as the e-mail
+        address is validated and looked up when logging in.
+        """
+        return 'email:%s' % email.strip().lower()
+
+    def allowed(self, email, address=None):
+        """Check whether a login attempt is allowed for the ``email`` and client ``address``.
+
+        :param email: The e-mail address used to log in
+        :type email: `unicode`
+        :param address: The client address
+        :type address: ``str``
+        :return: ``True`` if the login attempt may proceed
+        :rtype: ``bool``
+        """
+        since = time.time() - self.window
+        if self.store.count(self._email_key(email), since) >= self.limit:
+            return False
+        if address and self.store.count('address:%s' % address, since) >= self.address_limit:
+            return False
+        return True
+
+    def failure(self, email, address=None):
+        """Record a failed login attempt for the ``email`` and client ``address``.
+
+        :param email: The e-mail address used to log in
+        :type email: `unicode`
+        :param address: The client address
+        :type address: ``str``
+        """
+        now = time.time()
+        self.store.hit(self._email_key(email), now, self.window)
+        if address:
+            self.store.hit('address:%s' % address, now, self.window)
+
+    def success(self, email):
+        """Clear the failed login attempts for the ``email`` after a successful login.
+
+        :param email: The e-mail address used to log in
+        :type email: `unicode`
+        """
+        self.store.clear(self._email_key(email))
+
+
+# The process-wide login throttle. Set to False if throttling is disabled.
+active_throttle = None
+
+
+def get_login_throttle(request):
+    """Get the process-wide :class:`~pywebtools.pyramid.auth.throttle.LoginThrottle`, creating
+    it from the configuration settings on first access.
+
+    :param request: The request used to access the configuration settings
+    :type request: :class:`~pyramid.request.Request`
+    :return: The login throttle or ``None`` if throttling is disabled
+    :rtype: :class:`~pywebtools.pyramid.auth.throttle.LoginThrottle`
+    """
+    global active_throttle
+    if active_throttle is None:
+        limit = get_config_setting(request, 'auth.throttle.limit', target_type='int', default=0)
+        if limit:
+            path = get_config_setting(request, 'auth.throttle.sqlite')
+            if path:
+                store = SQLiteThrottleStore(path)
+            else:
+                store = MemoryThrottleStore()
+            active_throttle = LoginThrottle(store,
+                                            limit,
+                                            get_config_setting(request, 'auth.throttle.address_limit',
+                                                               target_type='int', default=limit * 5),
+                                            get_config_setting(request, 'auth.throttle.window',
+                                                               target_type='int', default=300))
+        else:
+            active_throttle = False
+    return active_throttle or None
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+#############################################################
+:mod:`pywebtools.pyramid.auth.tokens` -- Confirmation Tokens
+#############################################################
+
+The :mod:`~pywebtools.pyramid.auth.tokens` module provides the backends that issue and
+verify the tokens used for account confirmation and password resets:
+
+* :class:`~pywebtools.pyramid.auth.tokens.DatabaseTokenBackend` -- Stores each token as a
+  :class:`~pywebtools.pyramid.auth.models.TimeToken` row (default).
+* :class:`~pywebtools.pyramid.auth.tokens.SignedTokenBackend` -- Encodes the user, action,
+  and expiry in a HMAC-signed token, so that issuing and verifying tokens requires no
+  database writes or token lookups.
+
+The backend is selected via the ``auth.tokens.backend`` setting (see
+:func:`~pywebtools.pyramid.auth.init`).
+
+The module also removes expired :class:`~pywebtools.pyramid.auth.models.TimeToken` rows,
+which are otherwise only deleted when they are used. The deletion runs in bounded batches,
+without loading any ORM objects, and can be run either via the "pywebtools-sweep-tokens" console script::
+
+    pywebtools-sweep-tokens production.ini
+
+or periodically in the application process, by setting ``auth.tokens.sweep_interval``
+to the number of seconds between sweeps (see :func:`~pywebtools.pyramid.auth.init`) and
+calling :func:`~pywebtools.pyramid.auth.tokens.start_sweeper` from the application's WSGI
+app factory. As the thread does not survive a fork, it must be started in each process
+that should sweep tokens and not before a pre-forking server forks.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import and_, select
+from zope.sqlalchemy import mark_changed
+
+from pywebtools.pyramid.auth.models import TimeToken, User
+from pywebtools.pyramid.util import convert_type
+from pywebtools.sqlalchemy import DBSession
+
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseTokenBackend(object):
+    """The :class:`~pywebtools.pyramid.auth.tokens.DatabaseTokenBackend` stores each token as a
+    :class:`~pywebtools.pyramid.auth.models.TimeToken` in the database.
+    """
+
+    def issue(self, dbsession, user, action, lifetime):
+        """Issue a new token for the ``user`` and ``action``. Must be called within a transaction.
+
+        :param dbsession: The database session to use
+        :param user: The user to issue the token for
+        :type user: :class:`~pywebtools.pyramid.auth.models.User`
+        :param action: The action the token is for
+        :type action: `unicode`
+        :param lifetime: The number of seconds the token is valid for
+        :type lifetime: ``int``
+        :return: The new token
+        :rtype: :class:`~pywebtools.pyramid.auth.models.TimeToken`
+        """
+        token = TimeToken(user.id, action, datetime.now() + timedelta(seconds=lifetime))
+        dbsession.add(token)
+        return token
+
+    def issue_many(self, dbsession, users, action, lifetime):
+        """Issue a new token for each of the ``users`` and the ``action``, inserting all tokens
+        with a single bulk INSERT. The returned tokens are not attached to the ``dbsession``.
+        Must be called within a transaction.
+
+        :param dbsession: The database session to use
+        :param users: The users to issue the tokens for
+        :type users: ``list`` of :class:`~pywebtools.pyramid.auth.models.User`
+        :param action: The action the tokens are for
+        :type action: `unicode`
+        :param lifetime: The number of seconds the tokens are valid for
+        :type lifetime: ``int``
+        :return: The new tokens, in the same order as the ``users``
+        :rtype: ``list`` of :class:`~pywebtools.pyramid.auth.models.TimeToken`
+        """
+        timeout = datetime.now() + timedelta(seconds=lifetime)
+        tokens = [TimeToken(user.id, action, timeout) for user in users]
+        if tokens:
+            dbsession.execute(TimeToken.__table__.insert(),
+                              [{'user_id': token.user_id,
+                                'action': token.action,
+                                'token': token.token,
+                                'timeout': token.timeout} for token in tokens])
+            mark_changed(dbsession)
+        return tokens
+
+    def refresh(self, dbsession, token):
+        """Re-attach the ``token`` to the ``dbsession`` after the transaction it was issued in
+        has been committed.
+
+        :param dbsession: The database session to use
+        :param token: The token to re-attach
+        :type token: :class:`~pywebtools.pyramid.auth.models.TimeToken`
+        """
+        dbsession.add(token)
+
+    def find(self, dbsession, action, token):
+        """Find the valid token for the ``action`` with the given ``token`` value.
+
+        :param dbsession: The database session to use
+        :param action: The action the token must be for
+        :type action: `unicode`
+        :param token: The token value
+        :type token: `unicode`
+        :return: The token or ``None`` if there is no valid token
+        :rtype: :class:`~pywebtools.pyramid.auth.models.TimeToken`
+        """
+        return dbsession.query(TimeToken).filter(and_(TimeToken.action == action,
+                                                      TimeToken.token == token,
+                                                      TimeToken.timeout >= datetime.now())).first()
+
+    def consume(self, dbsession, token):
+        """Mark the ``token`` as used. Must be called within a transaction.
+
+        :param dbsession: The database session to use
+        :param token: The token to consume
+        :type token: :class:`~pywebtools.pyramid.auth.models.TimeToken`
+        """
+        dbsession.delete(token)
+
+
+class SignedToken(object):
+    """The :class:`~pywebtools.pyramid.auth.tokens.SignedToken` provides the same attributes as
+    the :class:`~pywebtools.pyramid.auth.models.TimeToken` for tokens issued by the
+    :class:`~pywebtools.pyramid.auth.tokens.SignedTokenBackend`.
+    """
+
+    def __init__(self, user, action, timeout, token):
+        self.user = user
+        self.user_id = user.id
+        self.action = action
+        self.timeout = timeout
+        self.token = token
+        self.data = None
+
+
+class SignedTokenBackend(object):
+    """The :class:`~pywebtools.pyramid.auth.tokens.SignedTokenBackend` encodes the user's id,
+    the action, the expiry time, and a fingerprint of the user's e-mail address, status,
+    and password in a HMAC-signed token. As the fingerprint changes when the account is
+    confirmed or the password is reset, each token can only be used once.
+    """
+
+    def __init__(self, secret):
+        """
+        :param secret: The secret used to sign the tokens
+        :type secret: `unicode`
+        """
+        self.secret = secret.encode('utf-8')
+
+    def _sign(self, value):
+        """Returns the URL-safe signature for the ``value``."""
+        digest = hmac.new(self.secret, value.encode('utf-8'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+    def _fingerprint(self, user):
+        """Returns the fingerprint of the ``user``'s current state."""
+        return self._sign('%s|%s|%s|%s' % (user.id, user.email, user.status, user.password))[:16]
+
+    def issue(self, dbsession, user, action, lifetime):
+        """Issue a new token for the ``user`` and ``action``.
+
+        :param dbsession: The database session to use
+        :param user: The user to issue the token for
+        :type user: :class:`~pywebtools.pyramid.auth.models.User`
+        :param action: The action the token is for
+        :type action: `unicode`
+        :param lifetime: The number of seconds the token is valid for
+        :type lifetime: ``int``
+        :return: The new token
+        :rtype: :class:`~pywebtools.pyramid.auth.tokens.SignedToken`
+        """
+        expiry = int(time.time()) + lifetime
+        payload = '%i.%s.%i.%s' % (user.id, action, expiry, self._fingerprint(user))
+        payload = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+        return SignedToken(user, action, datetime.fromtimestamp(expiry), '%s.%s' % (payload, self._sign(payload)))
+
+    def issue_many(self, dbsession, users, action, lifetime):
+        """Issue a new token for each of the ``users`` and the ``action``.
+
+        :param dbsession: The database session to use
+        :param users: The users to issue the tokens for
+        :type users: ``list`` of :class:`~pywebtools.pyramid.auth.models.User`
+        :param action: The action the tokens are for
+        :type action: `unicode`
+        :param lifetime: The number of seconds the tokens are valid for
+        :type lifetime: ``int``
+        :return: The new tokens, in the same order as the ``users``
+        :rtype: ``list`` of :class:`~pywebtools.pyramid.auth.tokens.SignedToken`
+        """
+        return [self.issue(dbsession, user, action, lifetime) for user in users]
+
+    def refresh(self, dbsession, token):
+        """Re-attach the ``token``'s user to the ``dbsession`` after the transaction the token
+        was issued in has been committed.
+
+        :param dbsession: The database session to use
+        :param token: The token to re-attach
+        :type token: :class:`~pywebtools.pyramid.auth.tokens.SignedToken`
+        """
+        dbsession.add(token.user)
+
+    def find(self, dbsession, action, token):
+        """Verify the ``token`` value for the ``action``. Only loads the token's user from the
+        database if the signature is valid and the token has not expired.
+
+        :param dbsession: The database session to use
+        :param action: The action the token must be for
+        :type action: `unicode`
+        :param token: The token value
+        :type token: `unicode`
+        :return: The token or ``None`` if the token is not valid
+        :rtype: :class:`~pywebtools.pyramid.auth.tokens.SignedToken`
+        """
+        try:
+            payload, signature = token.split('.')
+            if not hmac.compare_digest(signature.encode('ascii'), self._sign(payload).encode('ascii')):
+                return None
+            payload = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8')
+            user_id, token_action, expiry, fingerprint = payload.split('.')
+            user_id = int(user_id)
+            expiry = int(expiry)
+        except (ValueError, UnicodeError):
+            return None
+        if token_action != action or expiry < time.time():
+            return None
+        user = dbsession.query(User).get(user_id)
+        if user is None or not hmac.compare_digest(fingerprint.encode('ascii'),
+                                                   self._fingerprint(user).encode('ascii')):
+            return None
+        return SignedToken(user, action, datetime.fromtimestamp(expiry), token)
+
+    def consume(self, dbsession, token):
+        """Signed tokens are invalidated by the change to the user's state, so nothing needs
+        to be done.
+        """
+        pass
+
+
+active_backend = DatabaseTokenBackend()
+"""The token backend used by the authentication views."""
+
+
+def sweep_expired_tokens(engine=None, batch_size=1000, now=None):
+    """Deletes all :class:`~pywebtools.pyramid.auth.models.TimeToken` that expired before
+    ``now``. Each batch of at most ``batch_size`` tokens is deleted in its own transaction,
+    so that locks are only held briefly.
+
+    :param engine: The SQLAlchemy engine to use. If ``None``, uses the engine bound to the
+                   ``DBSession``
+    :param batch_size: The maximum number of tokens to delete per transaction. Must be greater
+                       than 0
+    :type batch_size: ``int``
+    :param now: The timestamp before which tokens are expired. If ``None``, uses the current time
+    :type now: :class:`~datetime.datetime`
+    :return: The number of deleted tokens
+    :rtype: ``int``
+    """
+    if batch_size <= 0:
+        raise ValueError('The batch size must be greater than 0')
+    if engine is None:
+        engine = DBSession.get_bind()
+    if now is None:
+        now = datetime.now()
+    table = TimeToken.__table__
+    expired = select([table.c.id]).where(table.c.timeout < now).limit(batch_size)
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            ids = [row[0] for row in connection.execute(expired)]
+            if ids:
+                connection.execute(table.delete().where(table.c.id.in_(ids)))
+        total = total + len(ids)
+        if len(ids) < batch_size:
+            break
+    return total
+
+
+class TokenSweeper(threading.Thread):
+    """The :class:`~pywebtools.pyramid.auth.tokens.TokenSweeper` is a daemon thread that
+    periodically runs :func:`~pywebtools.pyramid.auth.tokens.sweep_expired_tokens`.
+    """
+
+    def __init__(self, interval, batch_size=1000, engine=None):
+        """
+        :param interval: The number of seconds between sweeps
+        :type interval: ``int``
+        :param batch_size: The maximum number of tokens to delete per transaction
+        :type batch_size: ``int``
+        :param engine: The SQLAlchemy engine to use. If ``None``, uses the engine bound to the
+                       ``DBSession``
+        """
+        if batch_size <= 0:
+            raise ValueError('The batch size must be greater than 0')
+        threading.Thread.__init__(self, name='pywebtools-token-sweeper', daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.engine = engine
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                count = sweep_expired_tokens(engine=self.engine, batch_size=self.batch_size)
+                logger.info('Deleted %i expired time tokens', count)
+            except Exception:
+                logger.exception('Failed to delete expired time tokens')
+            finally:
+                if self.engine is None:
+                    DBSession.remove()
+
+    def stop(self):
+        """Stop the :class:`~pywebtools.pyramid.auth.tokens.TokenSweeper` after the current sweep."""
+        self._stopped.set()
+
+
+def start_sweeper(settings):
+    """Start a :class:`~pywebtools.pyramid.auth.tokens.TokenSweeper` in the current process,
+    if ``auth.tokens.sweep_interval`` is set.
+
+    :param settings: The application settings
+    :type settings: ``dict``
+    :return: The started sweeper or ``None``
+    :rtype: :class:`~pywebtools.pyramid.auth.tokens.TokenSweeper`
+    """
+    interval = convert_type(settings.get('auth.tokens.sweep_interval', ''), 'int')
+    if interval:
+        sweeper = TokenSweeper(interval,
+                               batch_size=convert_type(settings.get('auth.tokens.sweep_batch_size', ''),
+                                                       'int',
+                                                       default=1000))
+        sweeper.start()
+        return sweeper
+    return None
+
+
+def sweep_main(argv=None):
+    """Console script that deletes the expired :class:`~pywebtools.pyramid.auth.models.TimeToken`
+    from the database configured via the "sqlalchemy." settings in the given configuration file.
+    """
+    from pyramid.paster import get_appsettings, setup_logging
+    from sqlalchemy import engine_from_config
+
+    parser = argparse.ArgumentParser(description='Delete expired time tokens')
+    parser.add_argument('config_uri', help='The application configuration file')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='The maximum number of tokens to delete per transaction')
+    args = parser.parse_args(argv)
+    if args.batch_size <= 0:
+        parser.error('The batch size must be greater than 0')
+    setup_logging(args.config_uri)
+    engine = engine_from_config(get_appsettings(args.config_uri), 'sqlalchemy.')
+    count = sweep_expired_tokens(engine=engine, batch_size=args.batch_size)
+    print('Deleted %i expired time tokens' % count)
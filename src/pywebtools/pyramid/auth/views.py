@@ -14,20 +14,32 @@ not-logged in user) into the current request.
 from __future__ import (unicode_literals)  # Python 2.7 compatibility
 from nine import str
 
+import csv
+import io
+import json
 import re
 import transaction
 
-from datetime import datetime, timedelta
 from formencode import Invalid, validators, All, ForEach
 from formencode.variabledecode import NestedVariables
 from pyramid.httpexceptions import HTTPSeeOther, HTTPOk, HTTPNotFound
-from sqlalchemy import and_, or_
+from pyramid.response import Response
+from sqlalchemy import and_
 
 from pywebtools.formencode import (CSRFSchema, State, UniqueEmailValidator, EmailDomainValidator,
                                    PasswordValidator, DictValidator)
-from pywebtools.pyramid.util import get_config_setting, paginate
-from pywebtools.pyramid.auth.decorators import current_user, require_permission, unauthorised_redirect
-from pywebtools.pyramid.auth.models import User, TimeToken, Permission, PermissionGroup
+from pywebtools.pyramid.util import get_config_setting, get_count_strategy, paginate, keyset_paginate
+from pywebtools.pyramid.auth import tokens
+from pywebtools.pyramid.auth.outbox import enqueue_callback
+from pywebtools.pyramid.auth.search import get_search_index
+from pywebtools.pyramid.auth.autocomplete import get_autocomplete_index
+from pywebtools.pyramid.auth.cache import get_user_cache, invalidate_user
+from pywebtools.pyramid.auth.passwords import PasswordHasherBusy
+from pywebtools.pyramid.auth.throttle import get_login_throttle
+from pywebtools.pyramid.auth.decorators import (current_user, require_permission, require_logged_in,
+                                                unauthorised_redirect)
+from pywebtools.pyramid.auth.models import (User, Permission, PermissionGroup, bulk_validate_users,
+                                            bulk_delete_users)
 from pywebtools.sqlalchemy import DBSession
 
 # Post-action redirects
@@ -135,6 +147,14 @@ def login(request):
     password against the stored :class:`~pywebtools.pyramid.auth.models.User` and setting the
     necessary session variables if the login is successful.
 
+    If the user's password was hashed with outdated parameters, it is re-hashed with the
+    current parameters on a successful login. The user loaded while checking the password
+    is re-used for the login and, depending on the configuration, their permissions are
+    loaded and they are stored in the :class:`~pywebtools.pyramid.auth.cache.UserCache`.
+
+    If login throttling is enabled (see :mod:`~pywebtools.pyramid.auth.throttle`), then
+    throttled login attempts are rejected before any database access or password hashing.
+
     Uses either the ``return_to`` parameter in the request to redirect on success or
     the "user.login" redirection route, with parameter replacement "{uid}" will be replaced
     with the logged in user's identifier.
@@ -147,12 +167,32 @@ def login(request):
                 raise HTTPSeeOther(request.params['return_to'])
         redirect(request, 'user.login', uid=request.current_user.id)
     if request.method == 'POST':
+        throttle = get_login_throttle(request)
+        if throttle and not throttle.allowed(request.params.get('email', ''), request.client_addr):
+            msg = PasswordValidator().message('throttled', None)
+            return {'errors': {'email': msg,
+                               'password': msg},
+                    'values': request.params,
+                    'crumbs': [{'title': 'Login', 'url': request.route_url('user.login'), 'current': True}]}
         try:
             dbsession = DBSession()
-            params = LoginSchema().to_python(request.params, State(dbsession=dbsession,
-                                                                   request=request,
-                                                                   user_class=User))
-            user = dbsession.query(User).filter(User.email == params['email'].lower()).first()
+            state = State(dbsession=dbsession,
+                          request=request,
+                          user_class=User,
+                          throttle=throttle)
+            params = LoginSchema().to_python(request.params, state)
+            user = state.user
+            if user.password_needs_rehash():
+                with transaction.manager:
+                    dbsession.add(user)
+                    user.new_password(params['password'])
+                dbsession.add(user)
+                invalidate_user(user.id)
+            if get_config_setting(request, 'auth.permissions.eager', target_type='boolean', default=False):
+                user.load_permissions()
+            cache = get_user_cache(request)
+            if cache:
+                cache.store(user)
             request.current_user = user
             request.current_user.logged_in = True
             request.session['uid'] = user.id
@@ -167,6 +207,12 @@ def login(request):
                                                                  'password': e.msg},
                     'values': request.params,
                     'crumbs': [{'title': 'Login', 'url': request.route_url('user.login'), 'current': True}]}
+        except PasswordHasherBusy:
+            msg = 'Too many login attempts are currently being processed. Please try again in a moment.'
+            return {'errors': {'email': msg,
+                               'password': msg},
+                    'values': request.params,
+                    'crumbs': [{'title': 'Login', 'url': request.route_url('user.login'), 'current': True}]}
     return {'crumbs': [{'title': 'Login', 'url': request.route_url('user.login'), 'current': True}]}
 
 
@@ -237,13 +283,11 @@ def register(request):
                 dbsession.add(user)
             with transaction.manager:
                 dbsession.add(user)
-                token = TimeToken(user.id,
-                                  'validate_account',
-                                  datetime.now() + timedelta(seconds=3600))
-                dbsession.add(token)
+                token = tokens.active_backend.issue(dbsession, user, 'validate_account', 3600)
+                queued = enqueue_callback(dbsession, request, 'user.created', user, token)
             dbsession.add(user)
-            dbsession.add(token)
-            if 'user.created' in active_callbacks:
+            tokens.active_backend.refresh(dbsession, token)
+            if not queued and 'user.created' in active_callbacks:
                 active_callbacks['user.created'](request, user, token)
             redirect(request, 'user.register')
         except Invalid as e:
@@ -267,22 +311,18 @@ def confirm(request):
     If overriding the URL, the URL must only have a ``{token}`` parameter.
     """
     dbsession = DBSession()
-    token = dbsession.query(TimeToken).filter(and_(TimeToken.action == 'validate_account',
-                                                   TimeToken.token == request.matchdict['token'],
-                                                   TimeToken.timeout >= datetime.now())).first()
+    token = tokens.active_backend.find(dbsession, 'validate_account', request.matchdict['token'])
     if token:
         user = token.user
         with transaction.manager:
-            dbsession.delete(token)
+            tokens.active_backend.consume(dbsession, token)
             dbsession.add(user)
             user.status = 'active'
-            token = TimeToken(user.id,
-                              'reset_password',
-                              datetime.now() + timedelta(seconds=1200))
-            dbsession.add(token)
+            token = tokens.active_backend.issue(dbsession, user, 'reset_password', 1200)
+            queued = enqueue_callback(dbsession, request, 'user.validated', user, token)
         dbsession.add(user)
-        dbsession.add(token)
-        if 'user.validated' in active_callbacks:
+        tokens.active_backend.refresh(dbsession, token)
+        if not queued and 'user.validated' in active_callbacks:
             active_callbacks['user.validated'](request, user, token)
         return {'status': 'success',
                 'crumbs': [{'title': 'Login', 'url': request.route_url('user.login')},
@@ -337,25 +377,23 @@ def forgotten_password(request):
                 with transaction.manager:
                     dbsession.add(user)
                     if user.status == 'unconfirmed':
-                        token = TimeToken(user.id,
-                                          'validate_account',
-                                          datetime.now() + timedelta(seconds=3600))
-                        dbsession.add(token)
+                        token = tokens.active_backend.issue(dbsession, user, 'validate_account', 3600)
+                        queued = enqueue_callback(dbsession, request, 'user.created', user, token)
                     else:
-                        token = TimeToken(user.id,
-                                          'reset_password',
-                                          datetime.now() + timedelta(seconds=1200))
-                        dbsession.add(token)
+                        token = tokens.active_backend.issue(dbsession, user, 'reset_password', 1200)
+                        queued = enqueue_callback(dbsession, request, 'user.password_reset', user, token)
                 dbsession.add(user)
-                dbsession.add(token)
+                tokens.active_backend.refresh(dbsession, token)
                 if user.status == 'unconfirmed':
-                    if 'user.created' in active_callbacks:
+                    if not queued and 'user.created' in active_callbacks:
                         active_callbacks['user.created'](request, user, token)
                 else:
-                    if 'user.password_reset' in active_callbacks:
+                    if not queued and 'user.password_reset' in active_callbacks:
                         active_callbacks['user.password_reset'](request, user, token)
             else:
-                if 'user.password_reset_failed' in active_callbacks:
+                with transaction.manager:
+                    queued = enqueue_callback(dbsession, request, 'user.password_reset_failed')
+                if not queued and 'user.password_reset_failed' in active_callbacks:
                     active_callbacks['user.password_reset_failed'](request)
             if 'return_to' in request.params and request.params['return_to'] != request.current_route_url():
                 if '_default' in active_redirects and \
@@ -401,9 +439,7 @@ def reset_password(request):
     If overriding the URL, the URL must only have a ``{token}`` parameter.
     """
     dbsession = DBSession()
-    token = dbsession.query(TimeToken).filter(and_(TimeToken.action == 'reset_password',
-                                                   TimeToken.token == request.matchdict['token'],
-                                                   TimeToken.timeout >= datetime.now())).first()
+    token = tokens.active_backend.find(dbsession, 'reset_password', request.matchdict['token'])
     if token:
         if request.method == 'POST':
             try:
@@ -414,13 +450,15 @@ def reset_password(request):
                     dbsession.add(user)
                     user.new_password(params['password'])
                     user.login_limit = 0
-                    dbsession.delete(token)
+                    tokens.active_backend.consume(dbsession, token)
+                    queued = enqueue_callback(dbsession, request, 'user.password_reset_complete', user)
                 dbsession.add(user)
+                invalidate_user(user.id)
                 request.current_user = user
                 request.current_user.logged_in = True
                 request.session['uid'] = user.id
                 request.session.new_csrf_token()
-                if 'user.password_reset_complete' in active_callbacks:
+                if not queued and 'user.password_reset_complete' in active_callbacks:
                     active_callbacks['user.password_reset_complete'](request, user)
                 redirect(request, 'user.reset_password', uid=request.current_user.id)
             except Invalid as e:
@@ -448,40 +486,210 @@ def reset_password(request):
                                                      token=request.matchdict['token']), 'current': True}]}
 
 
-@current_user()
-@require_permission(permission='admin.users.view')
-def users(request):
-    """Handles the ``/users`` URL, displaying all users if the current
-    :class:`~pywebtools.pyramid.auth.models.User` has the "admin.users.view"
-    :class:`~pywebtools.pyramid.auth.models.Permission`.
+def filter_users(request, query):
+    """Applies the ``q`` and ``status`` parameters of the ``request`` to the ``query``. The
+    ``q`` parameter is matched via the search index (see :mod:`~pywebtools.pyramid.auth.search`).
+
+    :param request: The request to take the parameters from
+    :type request: :class:`~pyramid.request.Request`
+    :param query: The query to filter
+    :type query: :class:`~sqlalchemy.orm.query.Query`
+    :return: The filtered query and the list of (name, value) parameters that were applied
+    :rtype: ``tuple``
     """
-    dbsession = DBSession()
-    users = dbsession.query(User)
     query_params = []
     if 'q' in request.params and request.params['q']:
-        users = users.filter(or_(User.display_name.contains(request.params['q']),
-                                 User.email.contains(request.params['q'])))
+        query = query.filter(get_search_index().matches(request.params['q']))
         query_params.append(('q', request.params['q']))
     if 'status' in request.params and request.params['status']:
         query_params.append(('status', request.params['status']))
         if request.params['status'] == 'confirmed':
-            users = users.filter(User.status == 'active')
+            query = query.filter(User.status == 'active')
         else:
-            users = users.filter(User.status != 'active')
-    start = 0
-    if 'start' in request.params:
-        try:
-            start = int(request.params['start'])
-        except ValueError:
-            pass
-    users = users.order_by(User.display_name)
-    pages = paginate(request, 'users', users, start, 25, query_params=query_params)
-    users = users.offset(start).limit(25)
+            query = query.filter(User.status != 'active')
+    return query, query_params
+
+
+@current_user()
+@require_permission(permission='admin.users.view')
+def users(request):
+    """Handles the ``/users`` URL, displaying all users if the current
+    :class:`~pywebtools.pyramid.auth.models.User` has the "admin.users.view"
+    :class:`~pywebtools.pyramid.auth.models.Permission`.
+
+    The menu bars for all listed users are generated in one go and passed to the
+    template as ``menus``, keyed by the user's ``id``. The ``q`` and ``status`` parameters are
+    applied via :func:`~pywebtools.pyramid.auth.views.filter_users`.
+
+    If the ``auth.users.pagination`` setting is "keyset", then the users are paginated
+    using :func:`~pywebtools.pyramid.util.keyset_paginate` and the ``cursor`` parameter,
+    instead of the ``start`` offset. Otherwise the users are counted using the strategy
+    configured via the ``auth.users.count`` setting (see
+    :func:`~pywebtools.pyramid.util.get_count_strategy`).
+    """
+    dbsession = DBSession()
+    users, query_params = filter_users(request, dbsession.query(User))
+    if get_config_setting(request, 'auth.users.pagination', default='offset') == 'keyset':
+        users, pages = keyset_paginate(request, 'users', users, [User.display_name, User.id], 25,
+                                       cursor=request.params.get('cursor'), query_params=query_params)
+    else:
+        start = 0
+        if 'start' in request.params:
+            try:
+                start = int(request.params['start'])
+            except ValueError:
+                pass
+        users = users.order_by(User.display_name)
+        pages = paginate(request, 'users', users, start, 25, query_params=query_params, window=3,
+                         count=get_count_strategy(request, 'auth.users.count'))
+        users = users.offset(start).limit(25).all()
     return {'users': users,
+            'menus': User.admin_menus(users, request),
             'pages': pages,
             'crumbs': create_user_crumbs(request, [])}
 
 
+# The columns included in the users export
+export_columns = ['id', 'email', 'display_name', 'status']
+
+
+def export_rows(query, batch_size=1000):
+    """Generates the values of the ``export_columns`` for all users matched by the ``query``.
+    Only the exported columns are loaded and the rows are fetched in batches of ``batch_size``,
+    using a server-side cursor where the database supports it, so that the users are never
+    all held in memory.
+
+    The rows are read on a separate connection that is opened when the generator is first
+    advanced and closed when it finishes or is closed, independent of the request's
+    transaction, as the generator is consumed after the view has returned.
+
+    :param query: The query selecting the users to export
+    :type query: :class:`~sqlalchemy.orm.query.Query`
+    :param batch_size: The number of rows to fetch at a time
+    :type batch_size: ``int``
+    :return: A generator yielding one ``tuple`` of values per user
+    """
+    statement = query.with_entities(*[getattr(User, column) for column in export_columns]).\
+        order_by(User.id).statement
+    connection = query.session.get_bind().connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        try:
+            rows = result.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield tuple(row)
+                rows = result.fetchmany(batch_size)
+        finally:
+            result.close()
+    finally:
+        connection.close()
+
+
+# Characters that make spreadsheet applications treat a cell as a formula
+formula_prefixes = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _csv_cell(value):
+    """Escapes a text ``value`` that a spreadsheet application would treat as a formula."""
+    if isinstance(value, str) and value.startswith(formula_prefixes):
+        return "'%s" % value
+    return value
+
+
+def _csv_app_iter(rows, batch_size):
+    """Encodes the ``rows`` as UTF-8 CSV, yielding one chunk per ``batch_size`` rows. Text
+    values that start with a formula character are prefixed with "'".
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export_columns)
+    for idx, row in enumerate(rows, start=1):
+        writer.writerow([_csv_cell(value) for value in row])
+        if idx % batch_size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def _json_app_iter(rows, batch_size):
+    """Encodes the ``rows`` as a UTF-8 JSON list of objects, yielding one chunk per
+    ``batch_size`` rows.
+    """
+    chunk = ['[']
+    for idx, row in enumerate(rows):
+        if idx > 0:
+            chunk.append(',')
+        chunk.append(json.dumps(dict(zip(export_columns, row))))
+        if (idx + 1) % batch_size == 0:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk).encode('utf-8')
+
+
+@current_user()
+@require_permission(permission='admin.users.view')
+def export(request):
+    """Handles the ``/users/export`` URL, streaming all users that match the ``q`` and
+    ``status`` parameters (see :func:`~pywebtools.pyramid.auth.views.filter_users`) as a CSV
+    (default) or JSON file, depending on the ``format`` parameter. Requires that the current
+    :class:`~pywebtools.pyramid.auth.models.User` has the "admin.users.view"
+    :class:`~pywebtools.pyramid.auth.models.Permission`.
+
+    The response body is generated while it is sent, from the rows produced by
+    :func:`~pywebtools.pyramid.auth.views.export_rows`, so that the memory use does not
+    depend on the number of users. The batch size is configured via the
+    ``auth.users.export_batch_size`` setting (default 1000, at least 1).
+    """
+    batch_size = max(1, get_config_setting(request, 'auth.users.export_batch_size', target_type='int',
+                                           default=1000))
+    query, _ = filter_users(request, DBSession().query(User))
+    rows = export_rows(query, batch_size=batch_size)
+    if request.params.get('format') == 'json':
+        return Response(app_iter=_json_app_iter(rows, batch_size),
+                        content_type='application/json',
+                        charset='utf-8',
+                        content_disposition='attachment; filename="users.json"')
+    else:
+        return Response(app_iter=_csv_app_iter(rows, batch_size),
+                        content_type='text/csv',
+                        charset='utf-8',
+                        content_disposition='attachment; filename="users.csv"')
+
+
+@current_user()
+@require_logged_in()
+def autocomplete(request):
+    """Handles the ``/users/autocomplete`` URL, returning the users whose display name, any
+    word in their display name, or e-mail address starts with the ``q`` parameter as a JSON
+    list of objects with the keys "id", "display_name", and "email".
+
+    The users are found via the in-memory
+    :class:`~pywebtools.pyramid.auth.autocomplete.PrefixIndex`, without querying the database.
+    Only users that the current :class:`~pywebtools.pyramid.auth.models.User` may view are
+    returned. The number of users is limited by the optional ``limit`` parameter and the
+    ``auth.autocomplete.max_results`` setting (default 10).
+    """
+    q = request.params.get('q', '').strip()
+    if not q:
+        return []
+    limit = get_config_setting(request, 'auth.autocomplete.max_results', target_type='int', default=10)
+    try:
+        limit = max(1, min(limit, int(request.params.get('limit', limit))))
+    except ValueError:
+        pass
+    index = get_autocomplete_index(request, DBSession())
+    if request.current_user.has_permission('admin.users.view'):
+        matches = index.search(q, limit)
+    else:
+        # Without the permission, users may only view themselves
+        match = index.find(request.current_user.id, q)
+        matches = [match] if match is not None else []
+    return [{'id': match.id, 'display_name': match.display_name, 'email': match.email} for match in matches]
+
+
 class ActionSchema(CSRFSchema):
     """The :class:`~wte.views.user.ActionSchema` handles the validation of
     user action requests.
@@ -499,6 +707,8 @@ class ActionSchema(CSRFSchema):
     """Optional status parameter for the redirect"""
     start = validators.UnicodeString(if_empty=None, if_missing=None)
     """Optional start parameter for the redirect"""
+    cursor = validators.UnicodeString(if_empty=None, if_missing=None)
+    """Optional cursor parameter for the redirect"""
 
 
 @current_user()
@@ -508,33 +718,43 @@ def action(request):
     list of selected users. Requires that the current
     :class:`~wte.models.User` has the "admin.users.view"
     :class:`~wte.models.Permission`.
+
+    Each action is applied to all selected users with a few set-based statements, without
+    loading the users that are validated or deleted. For the "password" action, calls the
+    "users.password_reset" callback once with the current request and a list of
+    (:class:`~pywebtools.pyramid.auth.models.User`, token) pairs. If that callback is not
+    registered, calls the "user.password_reset" callback for each user instead.
     """
     dbsession = DBSession()
     try:
         query_params = []
-        for param in ['q', 'status', 'start']:
+        for param in ['q', 'status', 'start', 'cursor']:
             if param in request.params and request.params[param]:
                 query_params.append((param, request.params[param]))
         params = ActionSchema().to_python(request.params,
                                           State(request=request))
         if params['action'] != 'delete' or params['confirm']:
             with transaction.manager:
-                for user in dbsession.query(User).filter(User.id.in_(params['user_id'])):
-                    if params['action'] == 'validate':
-                        if user.status == 'unconfirmed' and user.allow('edit', request.current_user):
-                            user.status = 'active'
-                    elif params['action'] == 'delete':
-                        if user.allow('delete', request.current_user):
-                            dbsession.delete(user)
-                    elif params['action'] == 'password':
-                        if user.status == 'active' and user.allow('edit', request.current_user):
-                            token = TimeToken(user.id,
-                                              'reset_password',
-                                              datetime.now() + timedelta(seconds=1200))
-                            dbsession.add(token)
-                            dbsession.flush()
-                            if 'user.password_reset' in active_callbacks:
+                if params['action'] == 'validate':
+                    bulk_validate_users(dbsession, params['user_id'], request.current_user)
+                elif params['action'] == 'delete':
+                    bulk_delete_users(dbsession, params['user_id'], request.current_user)
+                elif params['action'] == 'password':
+                    selected = dbsession.query(User).filter(and_(User.id.in_(params['user_id']),
+                                                                 User.status == 'active',
+                                                                 User.allow_filter('edit',
+                                                                                   request.current_user))).all()
+                    resets = list(zip(selected, tokens.active_backend.issue_many(dbsession, selected,
+                                                                                 'reset_password', 1200)))
+                    if resets and 'users.password_reset' in active_callbacks:
+                        if not enqueue_callback(dbsession, request, 'users.password_reset', resets):
+                            active_callbacks['users.password_reset'](request, resets)
+                    elif 'user.password_reset' in active_callbacks:
+                        for user, token in resets:
+                            if not enqueue_callback(dbsession, request, 'user.password_reset', user, token):
                                 active_callbacks['user.password_reset'](request, user, token)
+            for user_id in params['user_id']:
+                invalidate_user(user_id)
             raise HTTPSeeOther(request.route_url('users', _query=query_params))
         else:
             return {'params': params,
@@ -554,8 +774,7 @@ def action(request):
 def view(request):
     """Handles the "/users/{uid}" URL, showing the user's profile.
     """
-    dbsession = DBSession()
-    user = dbsession.query(User).filter(User.id == request.matchdict['uid']).first()
+    user = request.context_object
     if user:
         if user.allow('view', request.current_user):
             return {'user': user,
@@ -592,7 +811,7 @@ def edit(request):
     functionality to update the user's profile.
     """
     dbsession = DBSession()
-    user = dbsession.query(User).filter(User.id == request.matchdict['uid']).first()
+    user = request.context_object
     if user:
         if user.allow('edit', request.current_user):
             crumbs = create_user_crumbs(request, [{'title': user.display_name,
@@ -610,6 +829,7 @@ def edit(request):
                                                                                            default=None),
                                                           user_class=User,
                                                           request=request))
+                    uid = user.id
                     with transaction.manager:
                         dbsession.add(user)
                         user.email = params['email']
@@ -624,6 +844,7 @@ def edit(request):
                                 else:
                                     options[key] = value
                         user.options = options
+                    invalidate_user(uid)
                     raise HTTPSeeOther(request.route_url('user.view', uid=request.matchdict['uid']))
                 except Invalid as e:
                     print(e)
@@ -671,6 +892,7 @@ def permissions(request):
                     else:
                         user.permissions = []
                 dbsession.add(user)
+                invalidate_user(user.id)
                 dbsession.add(request.current_user)
                 if request.current_user.has_permission('admin.users.view'):
                     raise HTTPSeeOther(request.route_url('users'))
@@ -708,14 +930,16 @@ def delete(request):
     the data that is linked to that :class:`~wte.models.User`.
     """
     dbsession = DBSession()
-    user = dbsession.query(User).filter(User.id == request.matchdict['uid']).first()
+    user = request.context_object
     if user:
         if user.allow('delete', request.current_user):
             if request.method == 'POST':
                 try:
                     CSRFSchema().to_python(request.params, State(request=request))
+                    uid = user.id
                     with transaction.manager:
                         dbsession.delete(user)
+                    invalidate_user(uid)
                     request.session.flash('The account has been deleted', queue='info')
                     if request.current_user.has_permission('admin.users.view'):
                         raise HTTPSeeOther(request.route_url('users'))
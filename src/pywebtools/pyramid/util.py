@@ -15,13 +15,25 @@ Utility functions for use with the Pyramid framework.
   HTTP methods.
 * :class:`~pywebtools.pyramid.util.MenuBuilder` is a helper class to generate
   the menu structure used with :func:`~pywebtools.kajiki.menubar`.
+* :func:`~pywebtools.pyramid.util.paginate` and :func:`~pywebtools.pyramid.util.keyset_paginate`
+  generate the list of pages used with the "navigation.pagination" helper. How
+  :func:`~pywebtools.pyramid.util.paginate` counts the rows is determined by the
+  :class:`~pywebtools.pyramid.util.ExactCount`, :class:`~pywebtools.pyramid.util.CachedCount`,
+  or :class:`~pywebtools.pyramid.util.CappedCount` strategies.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
+import base64
+import binascii
 import json
 import math
+import threading
+import time
+
+from collections import OrderedDict
 
 from pyramid.request import Request
+from sqlalchemy import and_, or_
 
 
 def request_from_args(*args):
@@ -177,8 +189,187 @@ class MenuBuilder(object):
         return self._groups
 
 
-def paginate(request, route_name, query, start, rows, query_params=None):
-    """Generates the list of pages for a query.
+class ExactCount(object):
+    """The :class:`~pywebtools.pyramid.util.ExactCount` counts all rows of the query on
+    every call.
+
+    All count strategies remove the query's ``ORDER BY`` before counting, so that the database
+    does not sort the rows it only has to count.
+    """
+
+    def count(self, query, start=0):
+        """Count the rows of the ``query``.
+
+        :param query: The SQLAlchemy query to count
+        :type query: :class:`~sqlalchemy.orm.query.Query`
+        :param start: The current starting index
+        :type start: :py:func:`int`
+        :return: The number of rows and whether that number is exact
+        :rtype: :py:func:`tuple`
+        """
+        return query.order_by(None).count(), True
+
+
+class CachedCount(object):
+    """The :class:`~pywebtools.pyramid.util.CachedCount` caches the number of rows for each
+    query, identified by its SQL and parameters, for ``ttl`` seconds. Changes to the rows
+    only become visible once the cached count has expired.
+    """
+
+    def __init__(self, ttl=60, size=1000):
+        """
+        :param ttl: The number of seconds a count is cached for
+        :type ttl: :py:func:`int`
+        :param size: The maximum number of cached counts
+        :type size: :py:func:`int`
+        """
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, query, start=0):
+        """Count the rows of the ``query``, using the cached count if one exists.
+
+        :param query: The SQLAlchemy query to count
+        :type query: :class:`~sqlalchemy.orm.query.Query`
+        :param start: The current starting index
+        :type start: :py:func:`int`
+        :return: The number of rows and whether that number is exact
+        :rtype: :py:func:`tuple`
+        """
+        query = query.order_by(None)
+        compiled = query.statement.compile()
+        key = (str(compiled), repr(sorted(compiled.params.items())))
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                timeout, count = self._entries[key]
+                if timeout >= now:
+                    self._entries.move_to_end(key)
+                    return count, True
+                del self._entries[key]
+        count = query.count()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, count)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return count, True
+
+
+class CappedCount(object):
+    """The :class:`~pywebtools.pyramid.util.CappedCount` only counts up to ``limit`` rows
+    beyond the current starting index, so that the count never has to scan the whole table.
+    If there are more rows, then the count is not exact.
+    """
+
+    def __init__(self, limit=1000):
+        """
+        :param limit: The maximum number of rows to count beyond the current starting index
+        :type limit: :py:func:`int`
+        """
+        self.limit = limit
+
+    def count(self, query, start=0):
+        """Count the rows of the ``query``, up to ``limit`` rows beyond ``start``.
+
+        :param query: The SQLAlchemy query to count
+        :type query: :class:`~sqlalchemy.orm.query.Query`
+        :param start: The current starting index
+        :type start: :py:func:`int`
+        :return: The number of rows and whether that number is exact
+        :rtype: :py:func:`tuple`
+        """
+        cap = start + self.limit
+        count = query.order_by(None).limit(cap + 1).count()
+        if count > cap:
+            return cap, False
+        return count, True
+
+
+# The count strategies created by get_count_strategy, by their settings key
+CACHED_COUNT_STRATEGIES = {}
+
+
+def get_count_strategy(request, key):
+    """Gets the count strategy configured via the configuration setting ``key``, which can
+    be "exact" (default), "cached", or "capped". The cache TTL and the count limit are
+    configured via the settings "``key``.ttl" (default 60) and "``key``.limit" (default 1000).
+    Strategies are created once per ``key``.
+
+    :param request: The request used to access the configuration settings
+    :type request: :class:`~pyramid.request.Request`
+    :param key: The configuration key
+    :type key: `unicode`
+    :return: The count strategy
+    """
+    if key not in CACHED_COUNT_STRATEGIES:
+        strategy = get_config_setting(request, key, default='exact')
+        if strategy == 'cached':
+            CACHED_COUNT_STRATEGIES[key] = CachedCount(ttl=get_config_setting(request, '%s.ttl' % key,
+                                                                              target_type='int', default=60))
+        elif strategy == 'capped':
+            CACHED_COUNT_STRATEGIES[key] = CappedCount(limit=get_config_setting(request, '%s.limit' % key,
+                                                                                target_type='int', default=1000))
+        else:
+            CACHED_COUNT_STRATEGIES[key] = ExactCount()
+    return CACHED_COUNT_STRATEGIES[key]
+
+
+class PageList(list):
+    """The :class:`~pywebtools.pyramid.util.PageList` is the list of pages generated by
+    :func:`~pywebtools.pyramid.util.paginate`. It also provides the number of rows as
+    ``count``, whether that number is ``exact``, and the ``count_label`` to display.
+    """
+
+    def __init__(self, count, exact):
+        list.__init__(self)
+        self.count = count
+        self.exact = exact
+
+    @property
+    def count_label(self):
+        """The number of rows, followed by a "+" if the number is not exact."""
+        return '%i' % self.count if self.exact else '%i+' % self.count
+
+
+class PageLink(dict):
+    """The :class:`~pywebtools.pyramid.util.PageLink` is a single entry in the list of pages
+    generated by :func:`~pywebtools.pyramid.util.paginate`. Its "url" is only generated when
+    it is first accessed.
+    """
+
+    def __init__(self, request, route_name, query_params, **kwargs):
+        dict.__init__(self, **kwargs)
+        self._url_args = (request, route_name, query_params)
+
+    def __missing__(self, key):
+        if key == 'url':
+            request, route_name, query_params = self._url_args
+            url = request.route_url(route_name, _query=query_params)
+            self['url'] = url
+            return url
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 'url' or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+def paginate(request, route_name, query, start, rows, query_params=None, window=None, count=None):
+    """Generates the list of pages for a query. The URLs of the pages are only generated
+    when they are accessed.
+
+    If a ``window`` is given, then only the first and last page and the ``window`` pages on
+    either side of the current page are included. Gaps between these are represented by
+    entries with the type "ellipsis".
+
+    The rows are counted using the ``count`` strategy. If the count is not exact, then the
+    last page is followed by an "ellipsis" entry and the "next" page is always available.
 
     :param request: The request used to generate URLs
     :type request: :class:`~pyramid.request.Request`
@@ -193,37 +384,168 @@ def paginate(request, route_name, query, start, rows, query_params=None):
     :param query_params: An optional list of query parameters to include in all
                          URLs that are generated
     :type query_params: :py:func:`list` of :py:func:`tuple`
+    :param window: The number of pages to include on either side of the current page. If
+                   ``None``, all pages are included
+    :type window: :py:func:`int`
+    :param count: The count strategy. If ``None``, the rows are counted exactly
+    :type count: :class:`~pywebtools.pyramid.util.ExactCount`
     :return: The :py:func:`list` of pages to use with the "navigation.pagination"
              helper
-    :rtype: :py:func:`list`
+    :rtype: :class:`~pywebtools.pyramid.util.PageList`
     """
     if query_params is None:
         query_params = []
     else:
         query_params = [param for param in query_params if param[0] != 'start']
-    count = query.count()
-    pages = []
+    if count is None:
+        count = ExactCount()
+    count, exact = count.count(query, start)
+    page_count = int(math.ceil(count / float(rows)))
+    pages = PageList(count, exact)
     if start > 0:
-        pages.append({'type': 'prev',
-                      'url': request.route_url(route_name, _query=query_params + [('start', max(start - rows, 0))])})
+        pages.append(PageLink(request, route_name, query_params + [('start', max(start - rows, 0))],
+                              type='prev'))
     else:
         pages.append({'type': 'prev'})
-    for idx in range(0, int(math.ceil(count / float(rows)))):
+    if window is None or page_count == 0:
+        indices = range(0, page_count)
+    else:
+        current = start // rows
+        indices = sorted(set([0, page_count - 1]).union(range(max(current - window, 0),
+                                                              min(current + window, page_count - 1) + 1)))
+    last = None
+    for idx in indices:
+        if last is not None and idx > last + 1:
+            pages.append({'type': 'ellipsis'})
+        last = idx
         if idx == (start / rows):
             pages.append({'type': 'current',
                           'label': str(idx + 1)})
         else:
-            pages.append({'type': 'item',
-                          'label': str(idx + 1),
-                          'url': request.route_url(route_name, _query=query_params + [('start', idx * rows)])})
-    if start + rows < count:
-        pages.append({'type': 'next',
-                      'url': request.route_url(route_name, _query=query_params + [('start', min(start + rows, count))])})
+            pages.append(PageLink(request, route_name, query_params + [('start', idx * rows)],
+                                  type='item',
+                                  label=str(idx + 1)))
+    if not exact:
+        pages.append({'type': 'ellipsis'})
+    if start + rows < count or not exact:
+        pages.append(PageLink(request, route_name, query_params + [('start', min(start + rows, count))],
+                              type='next'))
     else:
         pages.append({'type': 'next'})
     return pages
 
 
+def encode_cursor(direction, values):
+    """Encodes a keyset pagination cursor as an opaque, URL-safe token.
+
+    :param direction: The direction to page in, either "next" or "prev"
+    :type direction: :py:func:`str`
+    :param values: The values of the ordering columns to page from
+    :type values: :py:func:`list`
+    :return: The cursor token
+    :rtype: :py:func:`str`
+    """
+    return base64.urlsafe_b64encode(json.dumps([direction, values]).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a keyset pagination cursor generated by :func:`~pywebtools.pyramid.util.encode_cursor`.
+
+    :param cursor: The cursor token
+    :type cursor: :py:func:`str`
+    :return: The direction and the ordering column values or ``None`` if the cursor is not valid,
+             including if any of the values is not a string, number, boolean, or ``None``
+    :rtype: :py:func:`tuple`
+    """
+    try:
+        direction, values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        if direction in ['next', 'prev'] and isinstance(values, list) and \
+                all(value is None or isinstance(value, (str, int, float)) for value in values):
+            return direction, values
+    except (ValueError, TypeError, binascii.Error):
+        pass
+    return None
+
+
+def keyset_paginate(request, route_name, query, order_by, rows, cursor=None, query_params=None):
+    """Loads one page of a query using keyset pagination and generates the list of
+    pages for it. Instead of skipping the rows before the current page, the query is
+    filtered to the rows after (or before) the ordering column values of the last (or
+    first) row on the previous page, so that the cost of loading a page does not depend
+    on how deep the page is.
+
+    The ``order_by`` columns must be in ascending order, must together uniquely identify
+    each row (e.g. ``User.display_name, User.id``), must not contain ``NULL`` values, and
+    their values must be JSON-serialisable. The query must return model instances and
+    must not already be ordered or limited.
+
+    The list of pages only contains the "prev" and "next" entries, whose URLs contain the
+    opaque ``cursor`` query parameter.
+
+    :param request: The request used to generate URLs
+    :type request: :class:`~pyramid.request.Request`
+    :param route_name: The name of the route to use for URLs
+    :type route_name: :py:func:`str`
+    :param query: The SQLAlchemy query to paginate
+    :type query: :class:`~sqlalchemy.orm.query.Query`
+    :param order_by: The columns to order the query by
+    :type order_by: :py:func:`list`
+    :param rows: The number of rows per page
+    :type rows: :py:func:`int`
+    :param cursor: The cursor of the current page. If ``None`` or invalid, the first page is loaded
+    :type cursor: :py:func:`str`
+    :param query_params: An optional list of query parameters to include in all
+                         URLs that are generated
+    :type query_params: :py:func:`list` of :py:func:`tuple`
+    :return: The rows of the current page and the :py:func:`list` of pages to use with
+             the "navigation.pagination" helper
+    :rtype: :py:func:`tuple`
+    """
+    if query_params is None:
+        query_params = []
+    else:
+        query_params = [param for param in query_params if param[0] not in ['start', 'cursor']]
+    cursor = decode_cursor(cursor) if cursor else None
+    if cursor and len(cursor[1]) != len(order_by):
+        cursor = None
+    if cursor:
+        direction, values = cursor
+        comparisons = []
+        for idx, column in enumerate(order_by):
+            equal = [order_by[prev] == values[prev] for prev in range(0, idx)]
+            if direction == 'next':
+                comparisons.append(and_(*(equal + [column > values[idx]])))
+            else:
+                comparisons.append(and_(*(equal + [column < values[idx]])))
+        query = query.filter(or_(*comparisons))
+    else:
+        direction = 'next'
+    if direction == 'next':
+        items = query.order_by(*order_by).limit(rows + 1).all()
+    else:
+        items = query.order_by(*[column.desc() for column in order_by]).limit(rows + 1).all()
+    has_more = len(items) > rows
+    items = items[:rows]
+    if direction == 'prev':
+        items.reverse()
+    pages = []
+    if items and cursor and (direction == 'next' or has_more):
+        pages.append(PageLink(request, route_name,
+                              query_params + [('cursor', encode_cursor('prev', [getattr(items[0], column.key)
+                                                                                for column in order_by]))],
+                              type='prev'))
+    else:
+        pages.append({'type': 'prev'})
+    if items and (direction == 'prev' or has_more):
+        pages.append(PageLink(request, route_name,
+                              query_params + [('cursor', encode_cursor('next', [getattr(items[-1], column.key)
+                                                                                for column in order_by]))],
+                              type='next'))
+    else:
+        pages.append({'type': 'next'})
+    return items, pages
+
+
 def confirm_action(title, message, cancel, ok):
     """Generates a confirmation JSON object for use with the jQuery.postLink() plugin.
 
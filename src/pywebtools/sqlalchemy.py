@@ -11,17 +11,29 @@ template in your ``models`` module, remove the ``DBSession`` and ``Base`` and
 replace them imports from this module. Then do the same for the ``main`` function
 in the main package.
 
+Instead of creating the engine and binding the ``DBSession`` by hand, the ``main`` function
+can call :func:`~pywebtools.sqlalchemy.configure_engine` with the application settings.
+
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
+import functools
+import hashlib
 import json
+import os
+import re
+import tempfile
+import time
+import weakref
 
-from sqlalchemy import (text, UnicodeText)
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import (engine_from_config, event, func, text, UnicodeText)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, DisconnectionError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy.orm import (scoped_session, sessionmaker)
+from sqlalchemy.orm import (scoped_session, sessionmaker, Session)
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
 from sqlalchemy.types import TypeDecorator
+from sqlalchemy.util import asbool
 from zope.sqlalchemy import ZopeTransactionExtension
 
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
@@ -47,30 +59,325 @@ class DBUpgradeException(Exception):
             "and then start the application again."
 
 
-def check_database_version(db_version, dbsession=None):
+def configure_engine(settings, prefix='sqlalchemy.', dbsession=DBSession):
+    """Create the database engine from the ``settings`` and bind the ``dbsession`` to it. All
+    settings that start with the ``prefix`` are passed to :func:`~sqlalchemy.engine_from_config`,
+    so the URL and pool are configured via, for example:
+
+    * ``sqlalchemy.url`` -- The database URL
+    * ``sqlalchemy.pool_size`` / ``sqlalchemy.max_overflow`` / ``sqlalchemy.pool_timeout`` --
+      The size of the connection pool
+    * ``sqlalchemy.pool_recycle`` -- The number of seconds after which connections are replaced
+      (default 3600 for databases other than SQLite)
+    * ``sqlalchemy.pool_pre_ping`` -- Whether to test connections before they are used
+      (default true for databases other than SQLite)
+
+    For SQLite databases, the following pragmas are set on each new connection:
+
+    * ``sqlalchemy.sqlite.journal_mode`` -- The journal mode (default "wal", not used for
+      in-memory databases)
+    * ``sqlalchemy.sqlite.synchronous`` -- The synchronous mode (default "normal")
+    * ``sqlalchemy.sqlite.mmap_size`` -- The number of bytes of the database file that are
+      memory-mapped (default not set)
+
+    The ``sqlalchemy.json_codec`` setting selects the codec used by
+    :class:`~pywebtools.sqlalchemy.JSONUnicodeText` columns (see
+    :func:`~pywebtools.sqlalchemy.set_json_codec`).
+
+    Connections that a process inherits when it is forked, for example by a pre-forking
+    server, are never used by the new process (see
+    :func:`~pywebtools.sqlalchemy.make_fork_safe`).
+
+    :param settings: The application settings
+    :type settings: ``dict``
+    :param prefix: The prefix of the engine settings
+    :type prefix: ``str``
+    :param dbsession: The session to bind to the engine
+    :type dbsession: :func:`~sqlalchemy.orm.scoped_session`
+    :return: The new engine
+    :rtype: :class:`~sqlalchemy.engine.Engine`
+    """
+    engine_settings = {}
+    sqlite_settings = {}
+    for key, value in settings.items():
+        if key.startswith(prefix + 'sqlite.'):
+            sqlite_settings[key[len(prefix + 'sqlite.'):]] = value
+        elif key.startswith(prefix) and key != prefix + 'json_codec':
+            engine_settings[key] = value
+    url = make_url(engine_settings[prefix + 'url'])
+    if url.get_backend_name() != 'sqlite':
+        engine_settings.setdefault(prefix + 'pool_recycle', 3600)
+        engine_settings.setdefault(prefix + 'pool_pre_ping', True)
+    for key in ['pool_pre_ping', 'pool_use_lifo']:
+        if prefix + key in engine_settings:
+            engine_settings[prefix + key] = asbool(engine_settings[prefix + key])
+    engine = engine_from_config(engine_settings, prefix)
+    if url.get_backend_name() == 'sqlite':
+        pragmas = []
+        if url.database and url.database != ':memory:':
+            pragmas.append(('journal_mode', sqlite_settings.get('journal_mode', 'wal')))
+        pragmas.append(('synchronous', sqlite_settings.get('synchronous', 'normal')))
+        if sqlite_settings.get('mmap_size'):
+            pragmas.append(('mmap_size', int(sqlite_settings['mmap_size'])))
+        set_sqlite_pragmas(engine, pragmas)
+    make_fork_safe(engine)
+    if prefix + 'json_codec' in settings:
+        set_json_codec(settings[prefix + 'json_codec'])
+    dbsession.configure(bind=engine)
+    return engine
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """Set the ``pragmas`` on every new connection of the SQLite ``engine``.
+
+    :param engine: The engine to set the pragmas for
+    :type engine: :class:`~sqlalchemy.engine.Engine`
+    :param pragmas: The (name, value) pragmas to set
+    :type pragmas: ``list`` of ``tuple``
+    """
+    for name, value in pragmas:
+        if not re.match(r'^\w+$', name) or not re.match(r'^-?\w+$', str(value)):
+            raise ValueError('Invalid SQLite pragma %s = %s' % (name, value))
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+def make_fork_safe(engine):
+    """Ensure that a process that has been forked never uses the connections of the ``engine``
+    that it inherited from its parent process. After a fork, the child process replaces the
+    inherited pool with an empty one, without closing the connections, which are still used by
+    the parent. Connections that are nonetheless checked out in a different process are
+    discarded.
+
+    :param engine: The engine to make fork-safe
+    :type engine: :class:`~sqlalchemy.engine.Engine`
+    """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise DisconnectionError('Connection belongs to process %s, not %s' %
+                                     (connection_record.info['pid'], pid))
+
+    if hasattr(os, 'register_at_fork'):
+        engine_ref = weakref.ref(engine)
+
+        def after_fork():
+            forked_engine = engine_ref()
+            if forked_engine is not None:
+                forked_engine.pool = forked_engine.pool.recreate()
+        os.register_at_fork(after_in_child=after_fork)
+
+
+# The (database, version) pairs that have been checked in this process
+_checked_versions = set()
+
+
+def _database_key(bind):
+    """Returns a key identifying the database behind the ``bind``, which is an engine or a
+    connection, without exposing its password.
+    """
+    return hashlib.sha256(repr(getattr(bind, 'engine', bind).url).encode('utf-8')).hexdigest()
+
+
+def _read_stamp(stamp_file, stamp_ttl):
+    """Returns the content of the ``stamp_file``, if it exists and is not older than
+    ``stamp_ttl`` seconds.
+    """
+    try:
+        if time.time() - os.path.getmtime(stamp_file) <= stamp_ttl:
+            with open(stamp_file) as in_f:
+                return in_f.read()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _write_stamp(stamp_file, content):
+    """Atomically writes the ``content`` to the ``stamp_file``, ignoring any errors."""
+    try:
+        handle, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(stamp_file)))
+        with os.fdopen(handle, 'w') as out_f:
+            out_f.write(content)
+        os.replace(path, stamp_file)
+    except (IOError, OSError):
+        pass
+
+
+def check_database_version(db_version, dbsession=None, stamp_file=None, stamp_ttl=300):
     """Checks that the current version of the database matches the version specified
     by ``db_version``. This requires the use of the Alembic database migration library.
 
+    The version is read with a single query on the "alembic_version" table. If the table
+    does not exist, then the database is not managed by Alembic and the check passes.
+    Successful checks are remembered for the rest of the process and, if ``stamp_file``
+    is given, are recorded in that file. Further checks of the same version against the
+    same database within ``stamp_ttl`` seconds then do not access the database, which
+    avoids the query when many worker processes are restarted at the same time.
+
     :param db_version: The version identifier to check.
     :type db_version: ``str``
     :param dbsession: The database session to use for database access. If ``None`` will
                       create a new session.
     :type dbsession: :func:`~wlalchemy.orm.scoped_session`
+    :param stamp_file: Optional path of the file used to share successful checks between processes
+    :type stamp_file: ``str``
+    :param stamp_ttl: The number of seconds for which a successful check in the ``stamp_file``
+                      is trusted
+    :type stamp_ttl: ``int``
     """
     if not dbsession:
         dbsession = DBSession()
+    bind = dbsession.get_bind()
+    stamp = '%s\n%s' % (_database_key(bind), db_version)
+    if stamp in _checked_versions:
+        return
+    if stamp_file and _read_stamp(stamp_file, stamp_ttl) == stamp:
+        _checked_versions.add(stamp)
+        return
     try:
-        inspector = Inspector.from_engine(dbsession.bind)
-        if 'alembic_version' in inspector.get_table_names():
-            result = dbsession.query('version_num').\
-                from_statement(text('SELECT version_num FROM alembic_version WHERE version_num = :version_num')).\
-                params(version_num=db_version).first()
-            if not result:
-                result = dbsession.query('version_num').\
-                    from_statement('SELECT version_num FROM alembic_version').first()
-                raise DBUpgradeException(result[0], db_version)
-    except OperationalError:
+        try:
+            with bind.connect() as connection:
+                versions = [row[0] for row in connection.execute(text('SELECT version_num FROM alembic_version'))]
+        except DBAPIError:
+            # Check on a new connection, as the failed query may have aborted the transaction
+            with bind.connect() as connection:
+                if not bind.dialect.has_table(connection, 'alembic_version'):
+                    return
+            raise
+    except DBAPIError:
         raise DBUpgradeException('No version-information found', db_version)
+    if db_version not in versions:
+        raise DBUpgradeException(versions[0] if versions else 'No version-information found', db_version)
+    _checked_versions.add(stamp)
+    if stamp_file:
+        _write_stamp(stamp_file, stamp)
+
+
+class JSONCodec(object):
+    """The :class:`~pywebtools.sqlalchemy.JSONCodec` provides the functions used by the
+    :class:`~pywebtools.sqlalchemy.JSONUnicodeText` column to convert between Python values
+    and their JSON string representation.
+    """
+
+    def __init__(self, name, loads, dumps, strict_dumps=None):
+        """
+        :param name: The name of the codec
+        :type name: ``str``
+        :param loads: The function converting a JSON string to Python values
+        :param dumps: The function converting Python values to a JSON string
+        :param strict_dumps: The function converting Python values to a string that is valid
+                             JSON, raising a ``ValueError`` for values such as ``NaN`` that
+                             cannot be represented. Defaults to ``dumps``
+        """
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.strict_dumps = strict_dumps or dumps
+
+
+def _library_codec(name, loads, dumps):
+    """Returns the :class:`~pywebtools.sqlalchemy.JSONCodec` for the ``loads`` and ``dumps``
+    functions of a third-party JSON library. As these libraries either write ``NaN`` and
+    infinite numbers as ``null`` or reject them, values containing such numbers are written
+    and read via the standard library json module, so that they are neither lost nor
+    unreadable.
+    """
+    def strict_dumps(value):
+        try:
+            dumped = dumps(value)
+        except OverflowError as e:
+            raise ValueError(str(e))
+        if ('null' in dumped or 'NaN' in dumped or 'Infinity' in dumped) and _has_non_finite(value):
+            raise ValueError('Out of range float values are not JSON compliant')
+        return dumped
+
+    def lenient_dumps(value):
+        try:
+            return strict_dumps(value)
+        except ValueError:
+            return json.dumps(value)
+
+    def lenient_loads(value):
+        try:
+            return loads(value)
+        except ValueError:
+            return json.loads(value)
+    return JSONCodec(name, lenient_loads, lenient_dumps, strict_dumps)
+
+
+def _orjson_codec():
+    """Returns the :class:`~pywebtools.sqlalchemy.JSONCodec` using the orjson library."""
+    import orjson
+
+    def dumps(value):
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return _library_codec('orjson', orjson.loads, dumps)
+
+
+def _ujson_codec():
+    """Returns the :class:`~pywebtools.sqlalchemy.JSONCodec` using the ujson library."""
+    import ujson
+    return _library_codec('ujson', ujson.loads, ujson.dumps)
+
+
+json_codecs = {'orjson': _orjson_codec,
+               'ujson': _ujson_codec,
+               'json': lambda: JSONCodec('json', json.loads, json.dumps,
+                                         functools.partial(json.dumps, allow_nan=False))}
+"""The factories for the available :class:`~pywebtools.sqlalchemy.JSONCodec`, keyed by name."""
+
+# The process-wide JSON codec
+active_json_codec = json_codecs['json']()
+
+
+def set_json_codec(name='auto'):
+    """Set the :class:`~pywebtools.sqlalchemy.JSONCodec` used by all
+    :class:`~pywebtools.sqlalchemy.JSONUnicodeText` columns. If ``name`` is "auto", then
+    the fastest installed library is used (orjson), falling back to the standard library
+    json module.
+
+    :param name: The name of the codec: "auto", "orjson", "ujson", or "json"
+    :type name: ``str``
+    :return: The codec that is now used
+    :rtype: :class:`~pywebtools.sqlalchemy.JSONCodec`
+    """
+    global active_json_codec
+    if name == 'auto':
+        try:
+            active_json_codec = _orjson_codec()
+        except ImportError:
+            active_json_codec = json_codecs['json']()
+    elif name in json_codecs:
+        active_json_codec = json_codecs[name]()
+    else:
+        raise ValueError('Unknown JSON codec %s' % name)
+    return active_json_codec
+
+
+class JSONText(str):
+    """The :class:`~pywebtools.sqlalchemy.JSONText` is the undecoded JSON string returned by a
+    lazy :class:`~pywebtools.sqlalchemy.JSONUnicodeText` column. It is converted into a
+    :class:`~pywebtools.sqlalchemy.MutableDict` that only decodes the JSON when it is
+    first accessed.
+    """
+
+    def decode(self):
+        """Decode the JSON string.
+
+        :return: The decoded value
+        """
+        return active_json_codec.loads(str(self))
 
 
 class JSONUnicodeText(TypeDecorator):
@@ -78,38 +385,119 @@ class JSONUnicodeText(TypeDecorator):
     :class:`~sqlalchemy.UnicodeText` column type that does automatic conversion
     from the JSON string representation stored in the DB to a dict/list representation
     for use in python.
+
+    If the column is created with ``lazy=True``, then the JSON string is returned as
+    :class:`~pywebtools.sqlalchemy.JSONText` and is only decoded when the value is first
+    accessed. This requires that the column is wrapped via
+    ``MutableDict.as_mutable(JSONUnicodeText(lazy=True))`` and only stores ``dict`` values.
     """
 
     impl = UnicodeText
 
+    def __init__(self, *args, **kwargs):
+        """
+        :param lazy: Whether to defer decoding the JSON until the value is accessed
+        :type lazy: ``bool``
+        """
+        self.lazy = kwargs.pop('lazy', False)
+        TypeDecorator.__init__(self, *args, **kwargs)
+
     def process_bind_param(self, value, dialect):
-        """Convert the dict/list to JSON for storing.
+        """Convert the dict/list to JSON for storing. Values that have not been decoded are
+        stored unchanged.
         """
-        if value is not None:
-            value = json.dumps(value)
+        if isinstance(value, JSONText):
+            return str(value)
+        elif isinstance(value, MutableDict) and value.undecoded is not None:
+            return str(value.undecoded)
+        elif value is not None:
+            try:
+                dumped = active_json_codec.strict_dumps(value)
+            except (ValueError, OverflowError):
+                # Documents containing NaN or Infinity cannot be changed with the JSON functions
+                dumped = active_json_codec.dumps(value)
+                if isinstance(value, MutableDict):
+                    value._partial = False
+            value = dumped
         return value
 
     def process_result_value(self, value, dialect):
         """Convert the JSON to dict/list for use.
         """
         if value is not None:
-            value = json.loads(value)
+            if self.lazy:
+                value = JSONText(value)
+            else:
+                value = active_json_codec.loads(value)
         return value
 
 
+# Key of the placeholder entry of an undecoded MutableDict
+_UNDECODED = object()
+
+
+def _wrap(value, notify, path, exact):
+    """Wraps a plain ``dict`` or ``list`` ``value`` in a :class:`~pywebtools.sqlalchemy.MutableDict`
+    or :class:`~pywebtools.sqlalchemy.MutableList` that notifies ``notify`` of changes at the
+    ``path``. If ``exact`` is ``False``, then the ``path`` is that of the enclosing list and
+    changes are reported for the whole list. Any other ``value`` is returned unchanged.
+    """
+    if isinstance(value, dict) and not isinstance(value, MutableDict):
+        wrapped = MutableDict(value, __notify=notify)
+    elif isinstance(value, list) and not isinstance(value, MutableList):
+        wrapped = MutableList(value, __notify=notify)
+    else:
+        return value
+    wrapped._path = path
+    wrapped._exact = exact
+    return wrapped
+
+
+def _decoding(name):
+    """Returns a wrapper for the ``dict`` method ``name`` that decodes the
+    :class:`~pywebtools.sqlalchemy.MutableDict` and any undecoded
+    :class:`~pywebtools.sqlalchemy.MutableDict` arguments before calling the method.
+    """
+    method = getattr(dict, name)
+
+    def wrapper(self, *args, **kwargs):
+        if self.undecoded is not None:
+            self._decode()
+        for arg in args:
+            if isinstance(arg, MutableDict) and arg.undecoded is not None:
+                arg._decode()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
 class MutableDict(Mutable, dict):
     """The :class:`~pywebtools.sqlalchemy.MutableDict` is a ``dict`` extension for use
     with the :class:`~pywebtools.sqlalchemy.JSONUnicodeText` column. It monitors any
     change to its values and marks the column as dirty, if a change has occurred.
 
-    It is smart about its internal structure and will convert any nested ``dict`` into
-    :class:`~pywebtools.sqlalchemy.MutableDict` as well, to ensure that all changes
-    are tracked.
+    It is smart about its internal structure and will convert any nested ``dict`` or ``list``
+    into :class:`~pywebtools.sqlalchemy.MutableDict` or :class:`~pywebtools.sqlalchemy.MutableList`
+    when it is first accessed, to ensure that all changes are tracked. Changes to nested values
+    are notified to the outermost :class:`~pywebtools.sqlalchemy.MutableDict`, which records the
+    key paths that have changed in ``changed_paths`` (``None`` if the whole value has to be
+    written). These are used to write only the changed parts (see
+    :func:`~pywebtools.sqlalchemy.partial_json_update`).
+
+    If it is created from :class:`~pywebtools.sqlalchemy.JSONText`, then the JSON string is
+    stored in ``undecoded`` and is only decoded when the content is first accessed.
     """
 
+    undecoded = None
+    changed_paths = None
+    _path = ()
+    _exact = True
+    _partial = True
+
     def __init__(self, *args, **kwargs):
-        """Initialise the :class:`~pywebtools.sqlalchemy.MutableDict` and convert any nested
-        ``dict`` to :class:`~pywebtools.sqlalchemy.MutableDict`.
+        """Initialise the :class:`~pywebtools.sqlalchemy.MutableDict`. Nested values are only
+        converted when they are accessed.
 
         :params __notify: Optional :class:`~pywebtools.sqlalchemy.MutableDict` to notify
                           on changes. Needed for nested :class:`~pywebtools.sqlalchemy.MutableDict`.
@@ -121,30 +509,511 @@ class MutableDict(Mutable, dict):
         else:
             self.__notify = self
         dict.__init__(self, *args, **kwargs)
-        for k, v in self.items():
-            if isinstance(v, dict):
-                dict.__setitem__(self, k, MutableDict(v, __notify=self))
+
+    @classmethod
+    def associate_with_attribute(cls, attribute):
+        """Associate with the mapped ``attribute`` and, if it is a
+        :class:`~pywebtools.sqlalchemy.JSONUnicodeText` column, track the changed key paths
+        for partial updates. Used by SQLAlchemy.
+        """
+        super(MutableDict, cls).associate_with_attribute(attribute)
+        if isinstance(attribute.property.columns[0].type, JSONUnicodeText):
+            _track_partial_updates(attribute)
+
+    def changed_at(self, path):
+        """Record that the value at the key ``path`` has changed and mark as dirty. Must be
+        called on the outermost :class:`~pywebtools.sqlalchemy.MutableDict`.
+
+        :param path: The keys leading to the changed value. If empty, the whole value has
+                     changed
+        :type path: ``tuple``
+        """
+        if self.changed_paths is not None:
+            if path:
+                self.changed_paths.add(path)
+            else:
+                self.changed_paths = None
+        self.changed()
+
+    def _key_path(self, key):
+        """Returns the path to record for a change of the ``key``."""
+        if self._exact:
+            return self._path + (key, )
+        return self._path
+
+    def _check_aliases(self, values):
+        """Disables partial updates if any of the ``values`` is already tracked, as it may then
+        be reachable via more than one path.
+        """
+        for value in values:
+            if isinstance(value, (MutableDict, MutableList)):
+                self.__notify._partial = False
+                self.__notify.changed_paths = None
+
+    def _decode(self):
+        """Decode the ``undecoded`` JSON string into this :class:`~pywebtools.sqlalchemy.MutableDict`."""
+        value = self.undecoded.decode()
+        if not isinstance(value, dict):
+            raise ValueError('Lazy JSON values must be objects')
+        self.undecoded = None
+        dict.clear(self)
+        dict.update(self, value)
+
+    def _wrapped(self, key):
+        """Returns the value for the ``key``, converting a nested ``dict`` or ``list`` first."""
+        value = dict.__getitem__(self, key)
+        wrapped = _wrap(value, self.__notify, self._key_path(key), self._exact)
+        if wrapped is not value:
+            dict.__setitem__(self, key, wrapped)
+        return wrapped
+
+    def _wrap_all(self):
+        """Convert all nested ``dict`` and ``list`` values."""
+        if self.undecoded is not None:
+            self._decode()
+        for key in dict.keys(self):
+            self._wrapped(key)
 
     @classmethod
     def coerce(cls, key, value):
-        """Automatically coerce any ``dict`` to a :class:`~pywebtools.sqlalchemy.MutableDict`. Used
-        by SQLAlchemy.
+        """Automatically coerce any ``dict`` or :class:`~pywebtools.sqlalchemy.JSONText` to a
+        :class:`~pywebtools.sqlalchemy.MutableDict`. Used by SQLAlchemy.
         """
         if not isinstance(value, MutableDict):
-            if isinstance(value, dict):
+            if isinstance(value, JSONText):
+                lazy = MutableDict()
+                lazy.undecoded = value
+                # Placeholder entry, so that code that checks the size of the underlying dict
+                # (such as the json encoder) does not treat the undecoded value as empty
+                dict.__setitem__(lazy, _UNDECODED, None)
+                return lazy
+            elif isinstance(value, dict):
                 return MutableDict(value)
             return Mutable.coerce(key, value)
         else:
             return value
 
+    def __getitem__(self, key):
+        """Get a key's value."""
+        if self.undecoded is not None:
+            self._decode()
+        return self._wrapped(key)
+
+    def get(self, key, default=None):
+        """Get a key's value or the ``default`` if the key does not exist."""
+        if self.undecoded is not None:
+            self._decode()
+        if dict.__contains__(self, key):
+            return self._wrapped(key)
+        return default
+
+    def values(self):
+        """Get all values."""
+        self._wrap_all()
+        return dict.values(self)
+
+    def items(self):
+        """Get all (key, value) pairs."""
+        self._wrap_all()
+        return dict.items(self)
+
     def __setitem__(self, key, value):
         """Set an key's value and mark as dirty.
         """
+        if self.undecoded is not None:
+            self._decode()
+        self._check_aliases([value])
         dict.__setitem__(self, key, value)
-        self.__notify.changed()
+        self.__notify.changed_at(self._key_path(key))
 
     def __delitem__(self, key):
         """Delete a key and mark as dirty.
         """
+        if self.undecoded is not None:
+            self._decode()
         dict.__delitem__(self, key)
-        self.__notify.changed()
+        self.__notify.changed_at(self._key_path(key))
+
+    def setdefault(self, key, default=None):
+        """Get a key's value, setting it to ``default`` and marking as dirty if the key does
+        not exist.
+        """
+        if self.undecoded is not None:
+            self._decode()
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return self._wrapped(key)
+
+    def pop(self, key, *args):
+        """Remove a key and return its value, marking as dirty if the key existed."""
+        if self.undecoded is not None:
+            self._decode()
+        if dict.__contains__(self, key):
+            value = dict.pop(self, key)
+            self.__notify.changed_at(self._key_path(key))
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        """Remove and return a (key, value) pair and mark as dirty."""
+        if self.undecoded is not None:
+            self._decode()
+        item = dict.popitem(self)
+        self.__notify.changed_at(self._key_path(item[0]))
+        return item
+
+    def update(self, *args, **kwargs):
+        """Update the keys' values and mark as dirty."""
+        if self.undecoded is not None:
+            self._decode()
+        values = dict(*args, **kwargs)
+        self._check_aliases(values.values())
+        dict.update(self, values)
+        for key in values:
+            self.__notify.changed_at(self._key_path(key))
+
+    def clear(self):
+        """Remove all keys and mark as dirty."""
+        if self.undecoded is not None:
+            self._decode()
+        dict.clear(self)
+        self.__notify.changed_at(self._path)
+
+    def __ior__(self, other):
+        """Update the keys' values and mark as dirty."""
+        self.update(other)
+        return self
+
+    def __reduce_ex__(self, protocol):
+        """Copy or pickle the decoded content, which is wrapped again when unpickling."""
+        return (self.__class__, (dict(self.items()), ))
+
+
+for _name in ['__contains__', '__iter__', '__reversed__', '__len__', '__eq__', '__ne__', '__or__', '__ror__',
+              '__repr__', 'keys', 'copy']:
+    setattr(MutableDict, _name, _decoding(_name))
+
+
+class MutableList(Mutable, list):
+    """The :class:`~pywebtools.sqlalchemy.MutableList` is the ``list`` counterpart to the
+    :class:`~pywebtools.sqlalchemy.MutableDict`. It marks the column as dirty if the list is
+    changed in place and converts any nested ``dict`` or ``list`` when it is first accessed.
+    It is used for lists nested in a :class:`~pywebtools.sqlalchemy.MutableDict` and can be
+    used directly via ``MutableList.as_mutable(JSONUnicodeText)``. As the positions of the
+    values change when the list is changed, any change is recorded as a change of the whole
+    list.
+    """
+
+    changed_paths = None
+    _path = ()
+    _exact = True
+    _partial = True
+
+    def __init__(self, *args, **kwargs):
+        """Initialise the :class:`~pywebtools.sqlalchemy.MutableList`.
+
+        :params __notify: Optional :class:`~sqlalchemy.ext.mutable.Mutable` to notify on changes.
+                          Needed for nested :class:`~pywebtools.sqlalchemy.MutableList`.
+        :type __notify: :class:`~sqlalchemy.ext.mutable.Mutable`
+        """
+        if '__notify' in kwargs:
+            self.__notify = kwargs['__notify']
+            del kwargs['__notify']
+        else:
+            self.__notify = self
+        list.__init__(self, *args, **kwargs)
+
+    @classmethod
+    def coerce(cls, key, value):
+        """Automatically coerce any ``list`` to a :class:`~pywebtools.sqlalchemy.MutableList`.
+        Used by SQLAlchemy.
+        """
+        if not isinstance(value, MutableList):
+            if isinstance(value, list):
+                return MutableList(value)
+            return Mutable.coerce(key, value)
+        else:
+            return value
+
+    def changed_at(self, path):
+        """Record that the value at the key ``path`` has changed and mark as dirty. As lists
+        are always written completely, only marks as dirty.
+
+        :param path: The keys leading to the changed value
+        :type path: ``tuple``
+        """
+        self.changed()
+
+    def _changed(self, values=None):
+        """Notify that the list has changed, disabling partial updates if any of the
+        ``values`` is already tracked.
+        """
+        if values and any(isinstance(value, (MutableDict, MutableList)) for value in values):
+            self.__notify._partial = False
+            self.__notify.changed_paths = None
+        self.__notify.changed_at(self._path)
+
+    def __getitem__(self, index):
+        """Get the value at the ``index``. Slices are returned as plain, untracked lists."""
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return value
+        wrapped = _wrap(value, self.__notify, self._path, False)
+        if wrapped is not value:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __iter__(self):
+        """Iterate over the values."""
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __setitem__(self, index, value):
+        """Set the value at the ``index`` and mark as dirty."""
+        if isinstance(index, slice):
+            value = list(value)
+            list.__setitem__(self, index, value)
+            self._changed(value)
+        else:
+            list.__setitem__(self, index, value)
+            self._changed([value])
+
+    def __delitem__(self, index):
+        """Delete the value at the ``index`` and mark as dirty."""
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __iadd__(self, values):
+        """Extend with the ``values`` and mark as dirty."""
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        """Repeat the values ``count`` times and mark as dirty."""
+        list.__imul__(self, count)
+        self._changed()
+        return self
+
+    def append(self, value):
+        """Append the ``value`` and mark as dirty."""
+        list.append(self, value)
+        self._changed([value])
+
+    def extend(self, values):
+        """Extend with the ``values`` and mark as dirty."""
+        values = list(values)
+        list.extend(self, values)
+        self._changed(values)
+
+    def insert(self, index, value):
+        """Insert the ``value`` at the ``index`` and mark as dirty."""
+        list.insert(self, index, value)
+        self._changed([value])
+
+    def pop(self, *args):
+        """Remove and return a value and mark as dirty."""
+        value = list.pop(self, *args)
+        self._changed()
+        return value
+
+    def remove(self, value):
+        """Remove the first occurrence of the ``value`` and mark as dirty."""
+        list.remove(self, value)
+        self._changed()
+
+    def clear(self):
+        """Remove all values and mark as dirty."""
+        list.clear(self)
+        self._changed()
+
+    def reverse(self):
+        """Reverse the values in place and mark as dirty."""
+        list.reverse(self)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        """Sort the values in place and mark as dirty."""
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def __reduce_ex__(self, protocol):
+        """Copy or pickle the content, which is wrapped again when unpickling."""
+        return (self.__class__, (list(self), ))
+
+
+# The JSON attributes that support partial updates, as a dict of class to attribute names
+partial_update_attributes = {}
+# Whether the databases support the JSON functions, keyed by dialect
+_json_function_support = weakref.WeakKeyDictionary()
+
+
+def _has_non_finite(value):
+    """Check whether the ``value`` contains ``NaN`` or infinite numbers, which the database JSON
+    functions cannot handle. For an undecoded :class:`~pywebtools.sqlalchemy.MutableDict` this
+    is checked on the JSON string, which may report values that only appear in strings.
+    """
+    if isinstance(value, MutableDict) and value.undecoded is not None:
+        return 'NaN' in value.undecoded or 'Infinity' in value.undecoded
+    elif isinstance(value, float):
+        return value != value or value in (float('inf'), float('-inf'))
+    elif isinstance(value, dict):
+        return any(_has_non_finite(item) for item in dict.values(value))
+    elif isinstance(value, list):
+        return any(_has_non_finite(item) for item in list.__iter__(value))
+    elif isinstance(value, tuple):
+        return any(_has_non_finite(item) for item in value)
+    return False
+
+
+def _mark_clean(value, partial=None):
+    """Reset the changed key paths of the ``value`` after it has been loaded or written."""
+    if isinstance(value, MutableDict):
+        if partial is not None:
+            value._partial = partial
+        value.changed_paths = set() if value._partial else None
+
+
+def _track_partial_updates(attribute):
+    """Track the changed key paths of the :class:`~pywebtools.sqlalchemy.MutableDict` stored in
+    the mapped ``attribute``. Loaded values start without changes, while values assigned to the
+    ``attribute`` and values containing ``NaN`` or infinite numbers are written completely.
+    """
+    key = attribute.key
+    partial_update_attributes.setdefault(attribute.class_, set()).add(key)
+
+    def load(state, *args):
+        value = state.dict.get(key)
+        _mark_clean(value, not _has_non_finite(value))
+
+    def refresh(state, context, attrs):
+        if attrs is None or key in attrs:
+            load(state)
+
+    def set_(target, value, oldvalue, initiator):
+        if isinstance(value, MutableDict):
+            value.changed_paths = None
+        return value
+
+    event.listen(attribute.class_, 'load', load, raw=True, propagate=True)
+    event.listen(attribute.class_, 'refresh', refresh, raw=True, propagate=True)
+    event.listen(attribute, 'set', set_, raw=True, retval=True, propagate=True)
+
+
+def supports_json_functions(connection):
+    """Check whether the database behind the ``connection`` supports the SQLite JSON functions
+    ``json_set`` and ``json_remove``. The result is cached per dialect.
+
+    :param connection: The database connection to check
+    :return: ``True`` if the JSON functions are supported
+    :rtype: ``bool``
+    """
+    dialect = connection.dialect
+    if dialect not in _json_function_support:
+        supported = False
+        if dialect.name == 'sqlite':
+            try:
+                supported = connection.execute(text("SELECT json_set('{}', '$.a', json('1'))")).scalar() == '{"a":1}'
+            except OperationalError:
+                pass
+        _json_function_support[dialect] = supported
+    return _json_function_support[dialect]
+
+
+def _json_path(path):
+    """Returns the SQLite JSON path for the key ``path`` or ``None`` if a key cannot be
+    expressed in a path.
+    """
+    parts = ['$']
+    for key in path:
+        if not isinstance(key, str) or '"' in key:
+            return None
+        parts.append('."%s"' % key)
+    return ''.join(parts)
+
+
+def partial_json_update(column, value):
+    """Build the SQL expression that applies the changes recorded in the ``value``'s
+    ``changed_paths`` to the ``column``, using the SQLite ``json_set`` and ``json_remove``
+    functions.
+
+    :param column: The column storing the value
+    :type column: :class:`~sqlalchemy.schema.Column`
+    :param value: The changed value
+    :type value: :class:`~pywebtools.sqlalchemy.MutableDict`
+    :return: The SQL expression or ``None`` if the value has to be written completely, which
+             includes changed values that are not valid JSON, such as ``NaN``
+    """
+    if not value.changed_paths or value.undecoded is not None:
+        return None
+    paths = []
+    for path in sorted(value.changed_paths, key=len):
+        if not any(path[:len(other)] == other for other in paths):
+            paths.append(path)
+    updates = []
+    removes = []
+    for path in paths:
+        json_path = _json_path(path)
+        if json_path is None:
+            return None
+        current = value
+        for key in path:
+            if isinstance(current, dict) and dict.__contains__(current, key):
+                current = dict.__getitem__(current, key)
+            else:
+                removes.append(json_path)
+                break
+        else:
+            try:
+                updates.extend([json_path, func.json(active_json_codec.strict_dumps(current))])
+            except (ValueError, OverflowError):
+                return None
+    expression = column
+    if updates:
+        expression = func.json_set(expression, *updates)
+    if removes:
+        expression = func.json_remove(expression, *removes)
+    return expression
+
+
+@event.listens_for(Session, 'before_flush')
+def _partial_json_updates(session, flush_context, instances):
+    """Replaces changed :class:`~pywebtools.sqlalchemy.MutableDict` values that support partial
+    updates with the SQL expression that updates only the changed key paths. The values are
+    restored after the flush by :func:`~pywebtools.sqlalchemy._restore_json_values`.
+    """
+    flushed = []
+    supported = None
+    for obj in list(session.new) + list(session.dirty):
+        state = instance_state(obj)
+        for class_ in type(obj).__mro__:
+            for key in partial_update_attributes.get(class_, ()):
+                value = state.dict.get(key)
+                if not isinstance(value, MutableDict):
+                    continue
+                flushed.append((obj, key, value))
+                if value.changed_paths and key in state.committed_state and state.key is not None:
+                    if supported is None:
+                        supported = supports_json_functions(session.connection())
+                    expression = partial_json_update(state.mapper.get_property(key).columns[0], value) \
+                        if supported else None
+                    if expression is not None:
+                        state.dict[key] = expression
+    if flushed:
+        session.info['pywebtools.json_values'] = flushed
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _restore_json_values(session, flush_context):
+    """Restores the values replaced by :func:`~pywebtools.sqlalchemy._partial_json_updates`
+    without reloading them and resets their changed key paths.
+    """
+    for obj, key, value in session.info.pop('pywebtools.json_values', []):
+        if instance_state(obj).dict.get(key) is not value:
+            set_committed_value(obj, key, value)
+        _mark_clean(value)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_json_values(session, previous_transaction):
+    """Discards the replaced values if the flush failed."""
+    session.info.pop('pywebtools.json_values', None)
@@ -5,14 +5,18 @@
 
 The primary use point is the :func:`~pywebtools.testing.pyramid_app_tester`
 fixture, which generates a :class:`~pywebtools.testing.PyramidAppTester` for
-the given application.
+the given application. The :func:`~pywebtools.testing.smtp_server` fixture provides a
+:class:`~pywebtools.testing.LocalSMTPServer` that records all e-mails sent to it.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 
 import pytest
+import socketserver
+import threading
 
+from email import message_from_bytes
 from pyramid.paster import get_app
 from pyramid.request import Request
 from webtest import TestApp
@@ -237,3 +241,92 @@ def pyramid_app_tester(app):
     """
     tester = PyramidAppTester(app)
     yield tester
+
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    """The :class:`~pywebtools.testing.LocalSMTPHandler` implements the minimal subset of SMTP
+    needed to receive e-mails from :mod:`smtplib`.
+    """
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode('utf-8'))
+
+    def handle(self):
+        self.reply('220 localhost SMTP stand-in')
+        sender = None
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('utf-8').strip()
+            verb = command[:4].upper()
+            if verb in ['HELO', 'EHLO', 'NOOP']:
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender = command[10:].strip()
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                    if line.startswith(b'..'):
+                        line = line[1:]
+                    data.append(line)
+                self.server.messages.append({'sender': sender,
+                                             'recipients': recipients,
+                                             'message': message_from_bytes(b''.join(data))})
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender = None
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """The :class:`~pywebtools.testing.LocalSMTPServer` is a local stand-in for a SMTP server,
+    that records all e-mails sent to it in its ``messages`` list. Each message is a ``dict`` with
+    the keys "sender", "recipients", and "message" (an :class:`email.message.Message`).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), LocalSMTPHandler)
+        self.messages = []
+
+    @property
+    def port(self):
+        """The port the server is listening on."""
+        return self.server_address[1]
+
+    def start(self):
+        """Start the server in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self):
+        """Stop the server."""
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.yield_fixture
+def smtp_server():
+    """Fixture that provides a running :class:`~pywebtools.testing.LocalSMTPServer`.
+    """
+    server = LocalSMTPServer()
+    server.start()
+    yield server
+    server.stop()